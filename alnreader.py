@@ -3,21 +3,102 @@ import logging as log
 import xml.etree.ElementTree as et
 
 import argparse
+import hashlib
+import json
+import os
+import re
 import sys
-import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import vfs
 
 log.basicConfig(level=log.INFO)
 debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
 
 
+HEAD_SIZE = 4096
+root_tag_pat = re.compile(rb'<alignments\b([^>]*)>')
+attr_pat = re.compile(rb'([\w:.-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_entities = [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'), ('&apos;', "'"), ('&amp;', '&')]    # &amp; goes last
+
+
+def unescape(text: str) -> str:
+    """Same as xml.sax.saxutils.unescape with the quotes, without importing urllib along with it"""
+    if '&' in text:
+        for entity, char in _entities:
+            text = text.replace(entity, char)
+    return text
+
+
 def read_doc_id_mapping(aln_file):
-    aln_el = et.parse(aln_file).getroot()
-    return aln_el.attrib["source_id"], aln_el.attrib["translation_id"]
+    """
+    Reads the (source_id, translation_id) attributes of the root element.
+    Only the first few bytes of the file are read, the <alignment> elements are never parsed
+    """
+    with vfs.open_file(aln_file) as f:
+        head = f.read(HEAD_SIZE)
+        match = root_tag_pat.search(head)
+        if match:
+            attrs = {m.group(1).decode('utf-8'): unescape((m.group(2) or m.group(3) or b'').decode('utf-8'))
+                     for m in attr_pat.finditer(match.group(1))}
+        else:   # unusually long prolog; stop at the first start event instead
+            f.seek(0)
+            _, root_el = next(et.iterparse(f, events=('start',)))
+            attrs = root_el.attrib
+    return attrs["source_id"], attrs["translation_id"]
+
+
+def mapping_cache_path(aln_dir):
+    aln_dir = os.path.abspath(aln_dir)
+    digest = hashlib.md5(aln_dir.encode('utf-8')).hexdigest()
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_dir, 'realigner', f'aln-mapping-{digest}.json')
 
 
-def read_doc_alignments(aln_dir):
-    aln_files = glob.glob(f'{aln_dir}/*.aln.xml')
-    yield from (read_doc_id_mapping(f) for f in aln_files)
+def read_doc_alignments(aln_dir, workers=8, use_cache=True):
+    """
+    Reads the document mappings of all *.aln.xml files of a directory
+    :param aln_dir: directory having *.aln.xml files
+    :param workers: number of threads to scan the files
+    :param use_cache: reuse the mappings of the files whose mtime and size did not change since the last run.
+      The cache is only an optimization: when it can not be read or written, the files are scanned
+    :return: list of (source_id, translation_id)
+    """
+    files = vfs.scan(aln_dir, '*.aln.xml')
+    cache_path = mapping_cache_path(aln_dir)
+    cached = {}
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            assert isinstance(cached, dict)
+        except (OSError, ValueError, AssertionError) as e:
+            log.warning(f"Ignoring the mapping cache {cache_path}, which can not be read: {e!r}")
+            cached = {}
+    mappings, todo = {}, []
+    for path, mtime, size in files:
+        name = os.path.basename(path)
+        entry = cached.get(name)
+        if entry and entry[0] == mtime and entry[1] == size:
+            mappings[name] = entry
+        else:
+            todo.append((name, path, mtime, size))
+    log.info(f"{len(files)} aln files in {aln_dir}; {len(mappings)} from cache, scanning {len(todo)}")
+    if todo:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            ids = pool.map(read_doc_id_mapping, [path for _, path, _, _ in todo])
+            for (name, _, mtime, size), (src_id, tgt_id) in zip(todo, ids):
+                mappings[name] = [mtime, size, src_id, tgt_id]
+    if use_cache and (todo or len(mappings) != len(cached)):
+        tmp_path = f'{cache_path}.tmp{os.getpid()}'
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(mappings, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            log.warning(f"Could not write the mapping cache {cache_path}: {e}")
+    return [(mappings[os.path.basename(path)][2], mappings[os.path.basename(path)][3]) for path, _, _ in files]
 
 
 def write_out(recs, out):
@@ -30,6 +111,8 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument('-d', '--dir', type=str, help='Input directory having .aln.xml files', required=True)
     p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout, help='Output file path')
+    p.add_argument('-w', '--workers', type=int, default=8, help='Number of threads to scan the files')
+    p.add_argument('--no-cache', action='store_true', help='Do not use the cache of the previous scans')
     args = vars(p.parse_args())
-    recs = read_doc_alignments(args['dir'])
+    recs = read_doc_alignments(args['dir'], workers=args['workers'], use_cache=not args['no_cache'])
     write_out(recs, args['out'])
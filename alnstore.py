@@ -0,0 +1,174 @@
+"""
+Append only store of document alignments.
+
+All the alignments of a run go into a single JSON lines file (gzip compressed if the path ends with .gz),
+one line per document pair:
+    {"src_id": .., "tgt_id": .., "alignments": [[[src_seg_ids], [tgt_seg_ids], score], ...]}
+`AlignmentWriter` writes from a background thread with a large buffer, so the aligner never waits for disk.
+The LDC *.aln.xml layout can be regenerated from the store with `export_xml`.
+
+A run which was interrupted leaves an incomplete last line, or a truncated gzip stream, which makes the whole file
+unreadable past it once more alignments are appended. `read_done`, which a resumed run calls before appending,
+rewrites such a store with its complete records.
+"""
+import argparse
+import gzip
+import json
+import logging as log
+import os
+import queue
+import threading
+import zlib
+from typing import Iterator, List, Optional, Set, Tuple
+
+from realigner import Alignment, write_alignment
+
+log.basicConfig(level=log.INFO)
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8', buffering=1 << 20)
+
+
+class AlignmentWriter:
+    """Appends alignments to a store from a dedicated writer thread"""
+
+    def __init__(self, path, queue_size=10000):
+        """
+        :param path: path to the store; existing alignments are kept and the new ones are appended.
+          Call read_done first when the store may be from an interrupted run
+        :param queue_size: maximum number of alignments waiting to be written
+        """
+        self.path = path
+        self.count = 0
+        self._out = _open(path, 'a')
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, name='alignment-writer', daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            aln = self._queue.get()
+            if aln is None:
+                break
+            if self._error:
+                continue   # keep draining, so that the producers never block
+            try:
+                _write_record(self._out, aln)
+                self.count += 1
+            except Exception as e:
+                self._error = e
+
+    def write(self, aln: Alignment):
+        if self._error:
+            raise self._error
+        self._queue.put(aln)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._out.close()
+        log.info(f"Wrote {self.count} alignments to {self.path}")
+        if self._error:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _write_record(out, aln: Alignment):
+    out.write(json.dumps({'src_id': aln.src_id, 'tgt_id': aln.tgt_id, 'alignments': aln.alignments},
+                         ensure_ascii=False))
+    out.write('\n')
+
+
+def read_alignments(path, damages: Optional[List[str]] = None) -> Iterator[Alignment]:
+    """
+    :param damages: if given, the damages found in the store (incomplete lines, truncated stream) are added to it,
+      instead of being logged
+    :return: the complete alignments of the store; the reading stops at a truncated gzip stream
+    """
+    with _open(path, 'r') as inp:
+        i = 0
+        try:
+            for i, line in enumerate(inp, start=1):
+                if not line.strip():
+                    continue
+                if not line.endswith('\n'):     # the last line, cut off
+                    _damaged(path, damages, f'line {i} is incomplete')
+                    break
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    _damaged(path, damages, f'line {i} is incomplete')
+                    continue
+                yield Alignment(rec['src_id'], rec['tgt_id'], [tuple(aln) for aln in rec['alignments']])
+        except (EOFError, OSError, zlib.error) as e:
+            _damaged(path, damages, f'truncated after line {i} ({e})')
+
+
+def _damaged(path, damages: Optional[List[str]], msg: str):
+    if damages is None:
+        log.warning(f"{path}: {msg}, probably by an interrupted run. Skipped")
+    else:
+        damages.append(msg)
+
+
+def repair(path) -> int:
+    """
+    Rewrites a damaged store with its complete records only, so that more alignments can be appended to it
+    :return: number of alignments kept
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}' + ('.gz' if path.endswith('.gz') else '')
+    count = 0
+    with _open(tmp_path, 'w') as out:
+        for aln in read_alignments(path, damages=[]):
+            _write_record(out, aln)
+            count += 1
+    os.replace(tmp_path, path)
+    log.info(f"Repaired {path}: kept {count} alignments")
+    return count
+
+
+def read_done(path) -> Set[Tuple[str, str]]:
+    """(src_id, tgt_id) of the document pairs which are already in the store; a damaged store is repaired"""
+    if not os.path.exists(path):
+        return set()
+    damages = []
+    done = {(aln.src_id, aln.tgt_id) for aln in read_alignments(path, damages)}
+    if damages:
+        log.warning(f"{path} is damaged, probably by an interrupted run: {'; '.join(damages)}")
+        repair(path)
+    return done
+
+
+def export_xml(store_path, out_dir, swap=True):
+    """
+    Writes one LDC style aln.xml file per document pair, as realigner does without a store
+    :param store_path: path to the alignment store
+    :param out_dir: directory to write *.aln.xml files
+    :param swap: make english the source side; realigner does so by default
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    count = 0
+    for aln in read_alignments(store_path):
+        doc_id = aln.tgt_id if swap else aln.src_id
+        write_alignment(f'{out_dir}/{doc_id}.aln.xml', aln, swap=swap)
+        count += 1
+    log.info(f"Exported {count} alignments to {out_dir}")
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                description='Exports an alignment store to LDC style *.aln.xml files')
+    p.add_argument('-i', '--inp', dest='store_path', type=str, required=True, help='Alignment store file')
+    p.add_argument('-o', '--out', dest='out_dir', type=str, required=True, help='Output directory')
+    p.add_argument('--no-swap', dest='swap', action='store_false',
+                   help='Keep the non-english document as the source side')
+    export_xml(**vars(p.parse_args()))
@@ -0,0 +1,181 @@
+"""
+Document pair discovery.
+
+Proposes (source doc, english doc) pairs when sentence_alignment.old is missing or not trusted.
+Each source document is compared only with a shortlist of english documents, which is built from
+ 1. an inverted index of copy tokens (numbers and URLs, see `UnifiedScorer.copy_patterns`) and
+ 2. nearest neighbours of MCSS document embeddings (optional),
+and the shortlist is then reranked with `MCSS.doc_score` and copy token overlap.
+All doc x doc pairs are never computed.
+"""
+import argparse
+import logging as log
+import os
+import sys
+from collections import Counter, OrderedDict, defaultdict
+from math import log as ln
+from typing import Iterator, List, Set, Tuple
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from ltfreader import load_corpus, Doc
+from scorer import UnifiedScorer
+
+log.basicConfig(level=log.INFO)
+debug_mode = False
+
+
+def copy_tokens(doc: Doc) -> Set[str]:
+    """Set of copy tokens (numbers and URLs) found anywhere in the document"""
+    toks = set()
+    for _, text in doc.get_segs():
+        for pat in UnifiedScorer.copy_patterns:
+            toks.update(pat.findall(text))
+    return toks
+
+
+class CopyTokenIndex:
+    """Inverted index of copy tokens to documents"""
+
+    def __init__(self, doc_toks: List[Set[str]], max_postings=1000):
+        """
+        :param doc_toks: copy tokens of each document; documents are referred by their position in this list
+        :param max_postings: tokens appearing in more documents than this (such as "1") are ignored
+        """
+        self.num_docs = len(doc_toks)
+        postings = defaultdict(list)
+        for doc_idx, toks in enumerate(doc_toks):
+            for tok in toks:
+                postings[tok].append(doc_idx)
+        self.postings = {tok: docs for tok, docs in postings.items() if len(docs) <= max_postings}
+        log.info(f"Indexed {len(self.postings)} copy tokens; ignored {len(postings) - len(self.postings)} frequent ones")
+
+    def query(self, toks: Set[str], top_k=10) -> List[Tuple[int, float]]:
+        """
+        :param toks: copy tokens of the query document
+        :param top_k: number of documents to return
+        :return: [(doc_idx, score)] the documents sharing most (idf weighted) copy tokens with the query
+        """
+        scores = Counter()
+        for tok in toks:
+            docs = self.postings.get(tok)
+            if docs:
+                idf = ln(self.num_docs / len(docs)) + 1.0
+                for doc_idx in docs:
+                    scores[doc_idx] += idf
+        return scores.most_common(top_k)
+
+
+def _doc_text(doc: Doc) -> str:
+    return ' '.join(text for _, text in doc.get_segs())
+
+
+def _overlap(toks1: Set[str], toks2: Set[str]) -> float:
+    """Jaccard similarity of copy tokens; zero when there is nothing to compare"""
+    union = len(toks1 | toks2)
+    return len(toks1 & toks2) / union if union else 0.0
+
+
+def shortlist(src_docs: List[Doc], eng_docs: List[Doc], src_toks: List[Set[str]], eng_toks: List[Set[str]],
+              mcss=None, top_k=10, n_probe=16, max_postings=1000) -> Iterator[Tuple[int, Set[int]]]:
+    """
+    Finds candidate english documents for each source document
+    :return: iterator of (src_idx, {eng_idx})
+    """
+    tok_index = CopyTokenIndex(eng_toks, max_postings=max_postings)
+    emb_cands = None
+    if mcss is not None:
+        from miner import IVFIndex
+        eng_vecs = mcss.embed([_doc_text(doc) for doc in eng_docs], side='tgt')
+        index = IVFIndex(n_probe=n_probe).train(eng_vecs).add(eng_vecs)
+        _, emb_cands = index.search(mcss.embed([_doc_text(doc) for doc in src_docs], side='src'), k=top_k)
+    for src_idx, toks in enumerate(src_toks):
+        cands = {eng_idx for eng_idx, _ in tok_index.query(toks, top_k=top_k)}
+        if emb_cands is not None:
+            cands.update(int(eng_idx) for eng_idx in emb_cands[src_idx] if eng_idx >= 0)
+        yield src_idx, cands
+
+
+def match_docs(src_docs: List[Doc], eng_docs: List[Doc], mcss=None, top_k=10, threshold=0.0, n_probe=16,
+               max_postings=1000) -> List[Tuple[str, str, float]]:
+    """
+    Proposes one-to-one document pairs
+    :param src_docs: source language documents
+    :param eng_docs: english documents
+    :param mcss: MCSS instance for document similarity. Without it, only copy tokens are used
+    :param top_k: shortlist size per retrieval method
+    :param threshold: pairs with score below this are dropped
+    :param n_probe: number of lists to visit in the embedding index
+    :param max_postings: copy tokens shared by more documents than this are ignored
+    :return: [(src_doc_id, eng_doc_id, score)]
+    """
+    src_toks = [copy_tokens(doc) for doc in src_docs]
+    eng_toks = [copy_tokens(doc) for doc in eng_docs]
+    scores = {}
+    for src_idx, cands in shortlist(src_docs, eng_docs, src_toks, eng_toks, mcss=mcss, top_k=top_k,
+                                    n_probe=n_probe, max_postings=max_postings):
+        src_sents = [text for _, text in src_docs[src_idx].get_segs()]
+        for eng_idx in cands:
+            score = _overlap(src_toks[src_idx], eng_toks[eng_idx])
+            if mcss is not None:
+                eng_sents = [text for _, text in eng_docs[eng_idx].get_segs()]
+                score = (score + mcss.doc_score(src_sents, eng_sents)) / 2.0
+            scores[(src_idx, eng_idx)] = score
+    log.info(f"Scored {len(scores)} candidate pairs for {len(src_docs)} x {len(eng_docs)} documents")
+
+    # greedy one-to-one matching, same as the segment level re-alignment
+    items = sorted((entry for entry in scores.items() if entry[1] >= threshold), key=lambda x: x[1], reverse=True)
+    fwd_matching, rev_matching = OrderedDict(), set()
+    for (src_idx, eng_idx), score in items:
+        if src_idx not in fwd_matching and eng_idx not in rev_matching:
+            fwd_matching[src_idx] = eng_idx, score
+            rev_matching.add(eng_idx)
+    if debug_mode:
+        for src_idx in set(range(len(src_docs))) - fwd_matching.keys():
+            log.debug(f'Document: {src_docs[src_idx].doc_id} has no match')
+    return [(src_docs[src_idx].doc_id, eng_docs[eng_idx].doc_id, score)
+            for src_idx, (eng_idx, score) in fwd_matching.items()]
+
+
+def discover_doc_pairs(found_dir, src_lang, mcss=None, with_scores=False, **args) -> List[Tuple]:
+    """
+    Document mappings for realigner, in the same form as realigner.read_doc_alignments
+    :param with_scores: give (src_doc_id, eng_doc_id, score) instead
+    """
+    src_docs = load_corpus(f'{found_dir}/{src_lang}/ltf').docs
+    eng_docs = load_corpus(f'{found_dir}/eng/ltf').docs
+    pairs = match_docs(src_docs, eng_docs, mcss=mcss, **args)
+    return pairs if with_scores else [(src_id, eng_id) for src_id, eng_id, _ in pairs]
+
+
+def main(found_dir, src_lang, out, src_emb=None, eng_emb=None, max_vocab=int(1e6), **args):
+    mcss = None
+    if src_emb and eng_emb:
+        from mcss import MCSS
+        mcss = MCSS(src_vec_path=src_emb, tgt_vec_path=eng_emb, nmax=max_vocab)
+    pairs = discover_doc_pairs(found_dir, src_lang, mcss=mcss, with_scores=True, **args)
+    for src_id, eng_id, score in pairs:
+        out.write(f'{src_id}\t{eng_id}\t{score:.4f}\n')
+    log.info(f"Found {len(pairs)} document pairs")
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-fd', '--found-dir', type=str, required=True,
+                   help='Path to "found" dir that has eng and xyz lan')
+    p.add_argument('-l', '--lang', dest='src_lang', type=str, required=True, help='source language code')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
+                   help='Output file. Format: src_doc_id<tab>eng_doc_id<tab>score')
+    p.add_argument('-k', '--top-k', type=int, default=10, help='Shortlist size per retrieval method')
+    p.add_argument('-th', '--threshold', type=float, default=0.0,
+                   help='threshold score below which the document pairs must be ignored')
+    p.add_argument('-mp', '--max-postings', type=int, default=1000,
+                   help='Ignore copy tokens that appear in more documents than this')
+    p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+    p.add_argument('-se', '--src-emb', type=str, help='path to source language embedding (optional)')
+    p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (optional)')
+    p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size')
+    args = vars(p.parse_args())
+    if args.pop('debug'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+    main(**args)
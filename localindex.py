@@ -0,0 +1,295 @@
+"""
+Local, embedded replacement of the Solr client, for the boxes without a Solr server.
+
+Documents are stored as JSON in a SQLite file, and the text fields are indexed with FTS5. `LocalIndex` has the
+same post_items / post_iterator / commit / query / query_iterator methods as `solr.Solr`, and the responses have
+the same shape ({'response': {'numFound': .., 'docs': [..]}}), so it can be used wherever a Solr client is.
+See `solr.connect`, which picks this for any URL that is not http(s).
+
+Only the subset of the Solr query syntax used in this repo is understood:
+    *:*
+    field:value   field:"quoted value"   field:(a OR "b c")    (clauses separated by space or AND)
+Clauses on a text field are full text matches, ranked by bm25; other fields are matched exactly.
+"""
+import json
+import logging as log
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+log.basicConfig(level=log.INFO)
+debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
+
+clause_pat = re.compile(r'(?:([\w.]+):)?(\((?:[^()"]|"(?:[^"\\]|\\.)*")*\)|"(?:[^"\\]|\\.)*"|[^\s()]+)')
+term_pat = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_escape_pat = re.compile(r'\\(.)')
+_fts_ops = {'OR', 'AND', 'NOT'}
+_field_pat = re.compile(r'^\w+$')
+
+
+def _unescape(term: str) -> str:
+    return _escape_pat.sub(r'\1', term)
+
+
+def _typed(val: str):
+    """Parses numbers, so that they compare equal to the numbers stored in JSON"""
+    for typ in (int, float):
+        try:
+            return typ(val)
+        except ValueError:
+            pass
+    return val
+
+
+class LocalIndex:
+    """Solr like document store with full text search, in a single SQLite file"""
+
+    def __init__(self, path, text_fields=('text',), unique_key='id'):
+        """
+        :param path: path to the index file; created if missing
+        :param text_fields: fields to index for full text search; the others are matched exactly
+        :param unique_key: document field having the unique id
+        """
+        self.path = path
+        self.text_fields = list(text_fields)
+        self.unique_key = unique_key
+        self.posted_items = 0
+        self._local = threading.local()
+        con = self._con()
+        con.execute('CREATE TABLE IF NOT EXISTS docs (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, doc TEXT)')
+        con.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5({", ".join(self.text_fields)})')
+        con.commit()
+
+    def _con(self) -> sqlite3.Connection:
+        """Connection of this thread; sqlite connections can not be shared between threads"""
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=60)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+        return con
+
+    def post_items(self, items, commit=False, soft_commit=False):
+        """ post list of items; fields with {'set': value} update the existing document, like in Solr """
+        con = self._con()
+        fts_cols = ', '.join(self.text_fields)
+        fts_vals = ', '.join('?' * (len(self.text_fields) + 1))
+        try:
+            with con:
+                for item in items:
+                    doc_id = str(item[self.unique_key])
+                    row = con.execute('SELECT rowid, doc FROM docs WHERE id=?', (doc_id,)).fetchone()
+                    if row:
+                        rowid, doc = row[0], json.loads(row[1])
+                        for key, val in item.items():
+                            doc[key] = val['set'] if isinstance(val, dict) and 'set' in val else val
+                        con.execute('UPDATE docs SET doc=? WHERE rowid=?', (json.dumps(doc, ensure_ascii=False), rowid))
+                        con.execute('DELETE FROM fts WHERE rowid=?', (rowid,))
+                    else:
+                        doc = {key: val['set'] if isinstance(val, dict) and 'set' in val else val
+                               for key, val in item.items()}
+                        rowid = con.execute('INSERT INTO docs (id, doc) VALUES (?, ?)',
+                                            (doc_id, json.dumps(doc, ensure_ascii=False))).lastrowid
+                    con.execute(f'INSERT INTO fts (rowid, {fts_cols}) VALUES ({fts_vals})',
+                                (rowid, *(doc.get(field) for field in self.text_fields)))
+        except sqlite3.Error as e:
+            log.error(f'Posting to {self.path} failed: {e}')
+            return False
+        self.posted_items += len(items)
+        return True
+
+    def post_iterator(self, iter, commit=False, soft_commit=False, buffer_size=1000, progress_delay=2000,
+                      workers=1):
+        """
+        Posts all the items yielded by the input iterator; each buffer is written in a single transaction.
+        The arguments are the same as of Solr.post_iterator; workers is ignored, sqlite has a single writer
+        :return: (numDocs, True) on success, (numDocs, False) if any batch failed
+        """
+        num_docs, count, failed = 0, 0, 0
+        st = tt = time.time()
+        buffer = []
+        for doc in iter:
+            num_docs += 1
+            buffer.append(doc)
+            if len(buffer) >= buffer_size:
+                count += 1
+                failed += not self.post_items(buffer)
+                buffer = []
+            if (time.time() - tt) * 1000 > progress_delay:
+                tt = time.time()
+                log.info("%d batches, %d docs, %.1f docs/sec" % (count, num_docs, num_docs / (tt - st)))
+        if buffer:
+            count += 1
+            failed += not self.post_items(buffer)
+        log.info("Posted %d docs in %d batches, %.1f docs/sec; failed: %d batches"
+                 % (num_docs, count, num_docs / max(time.time() - st, 1e-3), failed))
+        return num_docs, failed == 0
+
+    def commit(self):
+        self._con().commit()
+        self.posted_items = 0
+
+    def _fts_expr(self, field: str, value: str) -> str:
+        if value.startswith('('):
+            value = value[1:-1]
+        terms = []
+        for match in term_pat.finditer(value):
+            quoted, bare = match.groups()
+            if bare in _fts_ops:
+                terms.append(bare)
+            else:
+                term = _unescape(quoted) if quoted is not None else bare
+                terms.append('"' + term.replace('"', '""') + '"')
+        return f'{field} : ({" ".join(terms)})'
+
+    def _where(self, query: str, fq=None):
+        """Translates a query and filter queries into (fts match expression, SQL conditions, SQL params)"""
+        queries = [query] + ([fq] if isinstance(fq, str) else list(fq or []))
+        fts, conds, params = [], [], []
+        for q in queries:
+            q = q.strip()
+            if not q or q == '*:*':
+                continue
+            for match in clause_pat.finditer(q):
+                field, value = match.groups()
+                if field is None and value == 'AND':
+                    continue
+                field = field or self.text_fields[0]
+                if field in self.text_fields:
+                    fts.append(self._fts_expr(field, value))
+                    continue
+                column = 'd.id' if field == self.unique_key else f"json_extract(d.doc, '$.{field}')"
+                if value == '*':
+                    conds.append(f'{column} IS NOT NULL')
+                    continue
+                if value.startswith('('):
+                    vals = [quoted if quoted is not None else bare
+                            for quoted, bare in (m.groups() for m in term_pat.finditer(value[1:-1]))
+                            if bare not in _fts_ops]
+                else:
+                    vals = [value[1:-1] if value.startswith('"') else value]
+                vals = [_unescape(v) for v in vals]
+                if field != self.unique_key:
+                    vals = [_typed(v) for v in vals]
+                conds.append(f'{column} IN ({", ".join("?" * len(vals))})')
+                params.extend(vals)
+        return ' AND '.join(fts), conds, params
+
+    def _order(self, sort: Optional[str], fts: bool) -> str:
+        if not sort:
+            return 'fts.rank' if fts else 'd.rowid'
+        clauses = []
+        for clause in sort.split(','):
+            field, direction = (clause.split() + ['asc'])[:2]
+            direction = direction.lower()
+            # both go into the SQL as they are
+            if direction not in ('asc', 'desc') or len(clause.split()) > 2:
+                raise ValueError(f'Invalid sort clause "{clause.strip()}"; expected: <field> [asc|desc]')
+            if not _field_pat.match(field):
+                raise ValueError(f'Invalid sort field "{field}"')
+            if field == 'score':
+                clauses.append(f'fts.rank {"asc" if direction == "desc" else "desc"}' if fts else 'd.rowid')
+            else:
+                column = 'd.id' if field == self.unique_key else f"json_extract(d.doc, '$.{field}')"
+                clauses.append(f'{column} {direction}')
+        return ', '.join(clauses)
+
+    def _select(self, query, fq=None, sort=None, after=None):
+        fts, conds, params = self._where(query, fq)
+        sql = 'FROM docs d'
+        if fts:
+            sql += ' JOIN fts ON fts.rowid = d.rowid'
+            conds.insert(0, 'fts MATCH ?')
+            params.insert(0, fts)
+        if after is not None:
+            conds.append('d.id > ?')
+            params.append(after)
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        return sql, params, self._order(sort, bool(fts))
+
+    @staticmethod
+    def _project(doc: Dict, fl: Optional[List[str]]) -> Dict:
+        return {key: val for key, val in doc.items() if key in fl} if fl else doc
+
+    def query(self, query='*:*', start=0, rows=20, fq=None, fl=None, sort=None, **kwargs):
+        """
+        Queries the index and returns results as a dictionary, in the shape of a Solr response
+        returns None on failure, items on success
+        """
+        fl = [f.strip() for f in fl.split(',')] if fl else None
+        try:
+            sql, params, order = self._select(query, fq, sort)
+            con = self._con()
+            total = con.execute(f'SELECT count(*) {sql}', params).fetchone()[0]
+            rows = con.execute(f'SELECT d.doc {sql} ORDER BY {order} LIMIT ? OFFSET ?', params + [rows, start])
+            docs = [self._project(json.loads(doc), fl) for doc, in rows]
+        except sqlite3.Error as e:
+            log.error(f'Query failed: {query} : {e}')
+            return None
+        return {'response': {'numFound': total, 'start': start, 'docs': docs}}
+
+    def query_many(self, queries: List[str], rows=20, **kwargs) -> List[Optional[Dict]]:
+        """Runs several queries in one read transaction"""
+        con = self._con()
+        with con:
+            con.execute('BEGIN')
+            return [self.query(q, rows=rows, **kwargs) for q in queries]
+
+    def query_iterator(self, query='*:*', start=0, rows=20, fq=None, fl=None, sort=None, **kwargs) -> Iterator:
+        """
+        Iterates over all the results. In the default order (unique key ascending), pages are fetched after the
+        key of the last result, like a cursorMark, so deep pages cost the same as the first; other sort orders
+        are paged by offsets
+        """
+        fl = [f.strip() for f in fl.split(',')] if fl else None
+        con = self._con()
+        keyset = not sort or sort.split() in ([self.unique_key], [self.unique_key, 'asc'])
+        last, offset = None, 0 if keyset else start
+        while True:
+            if keyset:
+                sql, params, _ = self._select(query, fq, after=last)
+                page = con.execute(f'SELECT d.id, d.doc {sql} ORDER BY d.id LIMIT ?', params + [rows]).fetchall()
+            else:
+                sql, params, order = self._select(query, fq, sort)
+                page = con.execute(f'SELECT d.id, d.doc {sql} ORDER BY {order} LIMIT ? OFFSET ?',
+                                   params + [rows, offset]).fetchall()
+                offset += len(page)
+            for doc_id, doc in page:
+                if keyset and start:
+                    start -= 1
+                    continue
+                yield self._project(json.loads(doc), fl)
+            if len(page) < rows:
+                break
+            last = page[-1][0]
+
+    def close(self):
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            con.commit()
+            con.close()
+            self._local.con = None
+
+    def __del__(self):
+        """ commit pending docs before close """
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                description='Bulk loads JSON lines documents into a local index')
+    p.add_argument('index', type=str, help='Path to the index file')
+    p.add_argument('-i', '--inp', type=argparse.FileType('r'), default=sys.stdin, help='JSON lines documents')
+    p.add_argument('-bs', '--buffer-size', type=int, default=5000, help='Number of docs per transaction')
+    p.add_argument('-tf', '--text-fields', type=str, default='text', help='Comma separated full text fields')
+    args = p.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.index)), exist_ok=True)
+    idx = LocalIndex(args.index, text_fields=args.text_fields.split(','))
+    idx.post_iterator((json.loads(line) for line in args.inp if line.strip()), buffer_size=args.buffer_size)
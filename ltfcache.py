@@ -0,0 +1,172 @@
+"""
+Pre-parsed binary cache of an LTF directory.
+
+`compile_dir` parses every {dir}/*.ltf.xml file once and stores all the documents in a single file:
+
+    magic | header length | JSON header | seg id offsets | text offsets | seg id buffer | text buffer
+
+The header has the doc index (doc id, lang, first and last segment) and the mtime, size and hash of each
+source file. Segment ids and texts are UTF-8 strings in two contiguous buffers, located by int64 offset arrays.
+`LTFCache` opens the file with mmap as a `Corpus`, so only the pages of the documents being read are ever
+loaded, and the strings are decoded lazily.
+A file whose mtime or size has changed is accepted only if its hash still matches; otherwise the caller is
+expected to fall back to parsing the XML.
+The LTF dirs inside archives (see vfs.py) have no cache; they are always parsed.
+"""
+import glob
+import hashlib
+import json
+import logging as log
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional
+
+import vfs
+from ltfreader import Corpus, Doc, read_ltf_docs
+
+MAGIC = b'LTFCACHE'
+VERSION = 1
+PREAMBLE = struct.Struct('<8sIIQ')   # magic, version, reserved, header length
+LTF_EXT = '.ltf.xml'
+
+
+def cache_path(dir_path: str) -> str:
+    """Default location of the cache of an LTF dir: a sibling file, so the LTF dir stays untouched"""
+    return os.path.normpath(dir_path) + '.cache'
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def compile_dir(dir_path: str, out_path: Optional[str] = None) -> str:
+    """
+    Parses all the LTF files in a directory and stores them in the binary cache format
+    :param dir_path: directory having *.ltf.xml files
+    :param out_path: path to the cache file; default is cache_path(dir_path)
+    :return: path to the cache file
+    """
+    assert not vfs.in_archive(dir_path), f'{dir_path} is in an archive; only the LTF dirs on disk can be compiled'
+    out_path = out_path or cache_path(dir_path)
+    paths = sorted(glob.glob(f'{dir_path}/*{LTF_EXT}'))
+    log.info(f"Compiling {len(paths)} LTF files from {dir_path} into {out_path}")
+    files, corpus = {}, Corpus()
+    for path in paths:
+        stat = os.stat(path)
+        doc_idxs = []
+        for doc in read_ltf_docs(path):
+            doc_idxs.append(len(corpus))
+            corpus.add_doc(doc)
+        files[os.path.basename(path)] = [stat.st_mtime_ns, stat.st_size, file_hash(path), doc_idxs]
+
+    docs = [[doc.doc_id, doc.lang, doc.first, doc.last] for doc in corpus]
+    header = json.dumps({'files': files, 'docs': docs, 'num_segs': corpus.num_segs()}).encode('utf-8')
+    header += b' ' * (-(PREAMBLE.size + len(header)) % 8)   # keep the offset arrays 8 byte aligned
+    tmp_path = f'{out_path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as out:
+        out.write(PREAMBLE.pack(MAGIC, VERSION, 0, len(header)))
+        out.write(header)
+        corpus.seg_offsets.tofile(out)
+        corpus.text_offsets.tofile(out)
+        out.write(corpus.seg_buf)
+        out.write(corpus.text_buf)
+    os.replace(tmp_path, out_path)   # readers never see a half written cache
+    log.info(f"Compiled {len(corpus)} docs, {corpus.num_segs()} segments into {out_path}")
+    return out_path
+
+
+class LTFCache:
+    """Read only, memory mapped view of a compiled LTF directory"""
+
+    def __init__(self, path: str, dir_path: Optional[str] = None):
+        """
+        :param path: path to the cache file
+        :param dir_path: LTF directory the cache was compiled from; needed for the staleness checks
+        """
+        self.path = path
+        self.dir_path = dir_path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, header_len = PREAMBLE.unpack_from(self.mm, 0)
+        assert magic == MAGIC, f'{path} is not an LTF cache'
+        assert version == VERSION, f'{path} has version {version}, but {VERSION} is expected; recompile it'
+        pos = PREAMBLE.size
+        header = json.loads(self.mm[pos: pos + header_len].decode('utf-8'))
+        pos += header_len
+        self.files: Dict[str, list] = header['files']
+        n = header['num_segs'] + 1
+        view = memoryview(self.mm)
+        seg_offsets = view[pos: pos + 8 * n].cast('q')
+        pos += 8 * n
+        text_offsets = view[pos: pos + 8 * n].cast('q')
+        pos += 8 * n
+        text_start = pos + seg_offsets[-1]
+        self.corpus = Corpus(seg_buf=view[pos: text_start], text_buf=view[text_start: text_start + text_offsets[-1]],
+                             seg_offsets=seg_offsets, text_offsets=text_offsets)
+        for doc_id, lang, first, last in header['docs']:
+            self.corpus.add_view(doc_id, lang, first, last)
+        self._fresh: Dict[str, bool] = {}
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def is_fresh(self, name: str) -> bool:
+        """
+        Checks that an LTF file is unchanged since the compilation: by mtime and size first, then by its hash
+        :param name: file name of the LTF file, relative to the LTF dir
+        """
+        if name not in self._fresh:
+            fresh = False
+            if name in self.files and self.dir_path:
+                mtime, size, digest, _ = self.files[name]
+                path = os.path.join(self.dir_path, name)
+                try:
+                    stat = os.stat(path)
+                    fresh = (stat.st_mtime_ns == mtime and stat.st_size == size) or file_hash(path) == digest
+                except FileNotFoundError:
+                    pass
+            if not fresh:
+                log.warning(f"Cache {self.path} is stale for {name}")
+            self._fresh[name] = fresh
+        return self._fresh[name]
+
+    def read_file(self, name: str) -> List[Doc]:
+        """Docs of an LTF file. The caller must check is_fresh(name) first"""
+        docs = self.corpus.docs
+        return [docs[doc_idx] for doc_idx in self.files[name][3]]
+
+    def get_doc(self, doc_id: str) -> Doc:
+        return self.corpus.get_doc(doc_id)
+
+    def close(self):
+        corpus = self.corpus
+        self.corpus = None
+        for buf in (corpus.seg_offsets, corpus.text_offsets, corpus.seg_buf, corpus.text_buf):
+            buf.release()
+        self.mm.close()
+
+
+_caches: Dict[str, Optional[LTFCache]] = {}   # opened caches of this process, by LTF dir
+
+
+def open_cache(dir_path: str) -> Optional[LTFCache]:
+    """Opens the cache of an LTF dir once per process; None if there is no cache"""
+    dir_path = os.path.normpath(dir_path)
+    if dir_path not in _caches:
+        path = cache_path(dir_path)
+        _caches[dir_path] = LTFCache(path, dir_path=dir_path) if os.path.exists(path) else None
+    return _caches[dir_path]
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                description='Compiles LTF directories into binary caches')
+    p.add_argument('dirs', type=str, nargs='+', help='LTF directories, such as found/eng/ltf')
+    p.add_argument('-o', '--out', type=str, help='Cache file path. Default: <dir>.cache (only for a single dir)')
+    args = p.parse_args()
+    assert not args.out or len(args.dirs) == 1, '--out is allowed only with a single dir'
+    for d in args.dirs:
+        compile_dir(d, args.out)
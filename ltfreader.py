@@ -1,29 +1,54 @@
 # Author :  Thamme Gowda ;; Created : July 04, 2018
 import logging as log
-import lxml.etree as et
-from collections import OrderedDict
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
 import argparse
 import sys
-import glob
+import os
+import multiprocessing as mp
+
+import vfs
 
 log.basicConfig(level=log.INFO)
 debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
 
 
 class Doc:
-    def __init__(self, doc_id, lang):
+    """
+    A document: an ordered collection of segments.
+    A standalone doc keeps its segments in an OrderedDict. A doc that is part of a Corpus is just a view of
+    a range of segments in the corpus buffers, and the strings are decoded only when they are asked for.
+    """
+    __slots__ = ('doc_id', 'lang', 'segs', 'corpus', 'first', 'last', '_index')
+
+    def __init__(self, doc_id, lang, corpus=None, first=0, last=0):
         self.doc_id = doc_id
         self.lang = lang
-        self.segs = OrderedDict()
+        self.corpus = corpus
+        self.first, self.last = first, last
+        self.segs = OrderedDict() if corpus is None else None
+        self._index = None
+
+    def __len__(self):
+        return len(self.segs) if self.corpus is None else self.last - self.first
 
     def add_seg(self, seg_id, text):
+        assert self.corpus is None, 'Segments of a corpus doc are read only'
         self.segs[seg_id] = text
 
     def get_segs(self):
-        return self.segs.items()
+        if self.corpus is None:
+            return self.segs.items()
+        corpus = self.corpus
+        return [(corpus.seg_id(i), corpus.text(i)) for i in range(self.first, self.last)]
 
     def get_seg(self, seg_id):
-        return self.segs[seg_id]
+        if self.corpus is None:
+            return self.segs[seg_id]
+        if self._index is None:
+            self._index = {self.corpus.seg_id(i): i for i in range(self.first, self.last)}
+        return self.corpus.text(self._index[seg_id])
 
     def to_recs(self):
         return [(self.doc_id, seg_id, text) for seg_id, text in self.get_segs()]
@@ -34,29 +59,216 @@ class Doc:
             yield {'id': uid, 'doc_id': self.doc_id, 'seg_id': seg_id, 'text': text, 'lang': self.lang, 'position': i}
 
 
+class Corpus:
+    """
+    Memory compact collection of documents.
+    Segment ids and texts of all the documents are stored as UTF-8 in two shared buffers, and located by int64
+    offset arrays; documents are views of segment ranges. The buffers may also be memory mapped (see ltfcache.py)
+    """
+    __slots__ = ('docs', 'seg_buf', 'text_buf', 'seg_offsets', 'text_offsets', '_doc_index', '_doc_starts')
+
+    def __init__(self, seg_buf=None, text_buf=None, seg_offsets=None, text_offsets=None):
+        self.seg_buf = bytearray() if seg_buf is None else seg_buf
+        self.text_buf = bytearray() if text_buf is None else text_buf
+        self.seg_offsets = array('q', [0]) if seg_offsets is None else seg_offsets
+        self.text_offsets = array('q', [0]) if text_offsets is None else text_offsets
+        self.docs = []
+        self._doc_index = None
+        self._doc_starts = None
+
+    @classmethod
+    def from_docs(cls, docs):
+        corpus = cls()
+        for doc in docs:
+            corpus.add_doc(doc)
+        return corpus
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def num_segs(self):
+        return len(self.seg_offsets) - 1
+
+    def seg_id(self, i):
+        return str(self.seg_buf[self.seg_offsets[i]: self.seg_offsets[i + 1]], 'utf-8')
+
+    def text(self, i):
+        return str(self.text_buf[self.text_offsets[i]: self.text_offsets[i + 1]], 'utf-8')
+
+    def texts(self, start=0, end=None):
+        """Texts of the segments in the range [start, end) of the whole corpus"""
+        end = self.num_segs() if end is None else min(end, self.num_segs())
+        return [self.text(i) for i in range(start, end)]
+
+    def add_view(self, doc_id, lang, first, last):
+        """Adds a doc for segments [first, last) which are already in the buffers"""
+        doc = Doc(doc_id, lang, corpus=self, first=first, last=last)
+        self.docs.append(doc)
+        self._doc_index = self._doc_starts = None
+        return doc
+
+    def add_doc(self, doc):
+        """Copies the segments of the doc into the buffers; returns the compact view of it"""
+        first = self.num_segs()
+        for seg_id, text in doc.get_segs():
+            self.seg_buf += seg_id.encode('utf-8')
+            self.text_buf += text.encode('utf-8')
+            self.seg_offsets.append(len(self.seg_buf))
+            self.text_offsets.append(len(self.text_buf))
+        return self.add_view(doc.doc_id, doc.lang, first, self.num_segs())
+
+    def get_doc(self, doc_id):
+        if self._doc_index is None:
+            self._doc_index = {doc.doc_id: doc for doc in self.docs}
+        return self._doc_index[doc_id]
+
+    def seg_doc(self, i):
+        """The doc which has the i'th segment of the corpus"""
+        if self._doc_starts is None:
+            self._doc_starts = array('q', (doc.first for doc in self.docs))
+        return self.docs[bisect_right(self._doc_starts, i) - 1]
+
+
+def _release(el):
+    """Frees the memory of an element which is already read, along with its preceding siblings"""
+    el.clear()
+    parent = el.getparent()
+    if parent is not None:
+        while el.getprevious() is not None:
+            del parent[0]
+
+
+_token_text = None   # XPath of the token texts; compiled on the first use, lxml is not needed for the caches
+
+
 def read_ltf_docs(path):
-    with open(path):
-        root = et.parse(path)
-        for doc_el in root.xpath('.//DOC'):
-            doc = Doc(doc_id=doc_el.attrib['id'], lang=doc_el.attrib['lang'])
-            for seg_el in doc_el.xpath('.//SEG'):
-                seg_id = seg_el.attrib['id']
-                tok_text = " ".join(seg_el.xpath('.//TOKEN/text()'))
+    """
+    Streams the documents of an LTF file.
+    The file is parsed incrementally and elements are released as soon as they are read,
+    so the memory is bounded by the size of one document rather than the whole file.
+    """
+    import lxml.etree as et
+    global _token_text
+    if _token_text is None:
+        _token_text = et.XPath('.//TOKEN/text()')
+    source = vfs.open_file(path) if vfs.in_archive(path) else path
+    segs = []
+    for _, el in et.iterparse(source, events=('end',), tag=('SEG', 'DOC')):
+        if el.tag == 'SEG':
+            segs.append((el.attrib['id'], " ".join(_token_text(el))))
+            _release(el)
+        else:
+            doc = Doc(doc_id=el.attrib['id'], lang=el.attrib['lang'])
+            for seg_id, tok_text in segs:
                 doc.add_seg(seg_id, tok_text)
+            segs = []
+            _release(el)
             yield doc
 
 
-def read_ltf_doc(path):
-    docs = list(read_ltf_docs(path))
+def read_cached_docs(path, use_cache=True):
+    """
+    Reads docs of an LTF file from the compiled cache of its directory (see ltfcache.py) if the cache
+    exists and is fresh for this file; parses the XML otherwise
+    """
+    if use_cache:
+        from ltfcache import open_cache
+        cache = open_cache(os.path.dirname(path))
+        name = os.path.basename(path)
+        if cache and cache.is_fresh(name):
+            return cache.read_file(name)
+    return read_ltf_docs(path)
+
+
+def read_ltf_doc(path, use_cache=True):
+    docs = list(read_cached_docs(path, use_cache=use_cache))
     assert len(docs) == 1
     return docs[0]
 
 
-def read_ltf_dir(dir_path):
-    paths = glob.glob(f'{dir_path}/*.ltf.xml')
+def read_ltf_dir(dir_path, use_cache=True):
+    paths = vfs.glob_files(f'{dir_path}/*.ltf.xml')
     log.info(f"Found {len(paths)} files")
     for path in paths:
-        yield from read_ltf_docs(path)
+        yield from read_cached_docs(path, use_cache=use_cache)
+
+
+def _parse_file(path):
+    """Parses an LTF file in a worker process; errors are returned rather than raised"""
+    try:
+        return list(read_ltf_docs(path)), None
+    except Exception as e:
+        return [], f'{type(e).__name__}: {e}'
+
+
+def read_ltf_dir_parallel(dir_path, workers=4, ordered=True, max_pending=None, timeout=600):
+    """
+    Parses the LTF files of a directory in a process pool.
+    :param dir_path: directory having *.ltf.xml files
+    :param workers: number of parser processes
+    :param ordered: yield docs in the order of files, as read_ltf_dir does. If False, docs are yielded as soon
+       as any file is parsed
+    :param max_pending: maximum number of files submitted but not yet consumed; this bounds the memory when
+       the consumer is slower than the parsers. Default is 4 x workers
+    :param timeout: seconds to wait for a file before giving up on it. The worker parsing it can not be stopped
+       alone, so the pool is restarted, and the pending files are parsed again by the new pool
+    :return: iterator of docs. A file which fails to parse or times out is logged and skipped
+    """
+    paths = iter(vfs.glob_files(f'{dir_path}/*.ltf.xml'))
+    max_pending = max_pending or 4 * workers
+    count, errors = 0, []
+    pool = mp.Pool(workers)
+    pending = deque()
+
+    def fill():
+        while len(pending) < max_pending:
+            path = next(paths, None)
+            if path is None:
+                break
+            pending.append([path, pool.apply_async(_parse_file, (path,)), 0.0])
+
+    try:
+        fill()
+        while pending:
+            ready = 0 if ordered else next((i for i, (_, res, _) in enumerate(pending) if res.ready()), None)
+            if ready is None:   # nothing is ready yet; wait on the oldest one
+                head = pending[0]
+                head[1].wait(0.1)
+                head[2] += 0.1
+                if head[1].ready() or head[2] < timeout:
+                    continue
+                ready = 0
+            path, res, _ = pending[ready]
+            del pending[ready]
+            fill()
+            try:
+                docs, error = res.get(timeout=timeout if ordered else 0)
+            except mp.TimeoutError:
+                docs, error = [], f'Timed out after {timeout}s'
+                # its worker is still busy with it; a few such files would take all the workers and stall the rest
+                log.warning(f"Restarting the parser pool, which is stuck on {path}")
+                pool.terminate()
+                pool = mp.Pool(workers)
+                for job in pending:
+                    if not job[1].ready():
+                        job[1], job[2] = pool.apply_async(_parse_file, (job[0],)), 0.0
+            if error:
+                log.error(f"Skip {path} :: {error}")
+                errors.append(path)
+                continue
+            count += 1
+            yield from docs
+    finally:
+        pool.terminate()
+    log.info(f"Parsed {count} files; skipped {len(errors)} files due to errors")
+
+
+def load_corpus(dir_path, use_cache=True):
+    """Reads all docs of an LTF dir into a memory compact Corpus"""
+    return Corpus.from_docs(read_ltf_dir(dir_path, use_cache=use_cache))
 
 
 def write_out(docs, out):
@@ -66,28 +278,35 @@ def write_out(docs, out):
             out.write('\n')
 
 
-def index_docs(docs, solr_url, corpus, buffer_size=2000):
-    from solr import Solr
-    solr = Solr(solr_url)
+def index_docs(docs, solr_url, corpus, buffer_size=2000, solr_workers=4):
+    from solr import connect
+    solr = connect(solr_url, pool_size=solr_workers)
     docs = (seg for doc in docs for seg in doc.to_rec_dicts())
 
     def set_corpus(doc):
         doc['corpus'] = corpus
         return doc
     docs = map(set_corpus, docs)
-    solr.post_iterator(docs, buffer_size=buffer_size)
+    return solr.post_iterator(docs, buffer_size=buffer_size, workers=solr_workers)
 
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument('-d', '--dir', type=str, help='Input directory having LTF files')
     p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout, help='Output file path')
-    p.add_argument('-s', '--solr-url', type=str, help='Index to Solr. (optional)')
+    p.add_argument('-s', '--solr-url', type=str, help='Index to Solr, or to a local index file (see localindex.py). (optional)')
     p.add_argument('-c', '--corpus', type=str, help='Tag all the documents with this string in solr index')
+    p.add_argument('-w', '--workers', type=int, default=1, help='Number of processes to parse the LTF files')
+    p.add_argument('-sw', '--solr-workers', type=int, default=4, help='Number of batches to post to Solr concurrently')
+    p.add_argument('-u', '--unordered', action='store_true',
+                   help='With --workers > 1, emit docs as soon as they are parsed instead of in the file order')
     args = vars(p.parse_args())
-    docs = read_ltf_dir(args['dir'])
-    if 'solr_url' in args:
-        assert 'corpus' in args, '--corpus is needed'
-        index_docs(docs, args['solr_url'], args['corpus'])
+    if args['workers'] > 1:
+        docs = read_ltf_dir_parallel(args['dir'], workers=args['workers'], ordered=not args['unordered'])
+    else:
+        docs = read_ltf_dir(args['dir'])
+    if args['solr_url']:
+        assert args['corpus'], '--corpus is needed'
+        index_docs(docs, args['solr_url'], args['corpus'], solr_workers=args['solr_workers'])
     else:
         write_out(docs, args['out'])
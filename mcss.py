@@ -3,7 +3,6 @@ import io
 import logging
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 
 logger = logging.getLogger()
@@ -35,6 +34,12 @@ def load_vec(emb_path, nmax=1e9):
     return embeddings, id2word, word2id, word_vec
 
 
+def cosine(u, v) -> float:
+    """Cosine similarity of two vectors; 0 if any of them is a zero vector, like sklearn's cosine_similarity"""
+    norm = np.linalg.norm(u) * np.linalg.norm(v)
+    return float(np.dot(u, v) / norm) if norm else 0.0
+
+
 def bow(sentences, word_vec, normalize=False):
     """
     Get sentence representations using average bag-of-words.
@@ -52,7 +57,7 @@ def bow(sentences, word_vec, normalize=False):
         if len(sentvec) == 0:
             sentvec = [word_vec[list(word_vec.keys())[0]]]
         embeddings.append(np.mean(sentvec, axis=0))
-    if count['oov'] / count['tol'] > 0.5:
+    if count['tol'] and count['oov'] / count['tol'] > 0.5:
         logger.debug('# of oov: %s %s' % (count['oov'], count['tol']))
     return np.vstack(embeddings)
 
@@ -76,6 +81,8 @@ def bow_idf(sentences, word_vec, idf_dict=None):
 
 class MCSS:
 
+    score_range = (-1.0, 1.0)   # cosine similarity
+
     def __init__(self, src_vec_path, tgt_vec_path, nmax=3e5):
         _, _, _, self.src_vec = load_vec(src_vec_path, nmax=nmax)
         _, _, _, self.tgt_vec = load_vec(tgt_vec_path, nmax=nmax)
@@ -85,7 +92,35 @@ class MCSS:
         tgt_sents = [tgt_sent.lower().split()]
         src_vectors = bow(src_sents, self.src_vec)
         tgt_vectors = bow(tgt_sents, self.tgt_vec)
-        return float(cosine_similarity(src_vectors, tgt_vectors))
+        return cosine(src_vectors[0], tgt_vectors[0])
+
+    def embed(self, sents, side='src'):
+        """
+        Embeds a batch of sentences into the common space
+        :param sents: list of sentences
+        :param side: 'src' to use the source language vectors, 'tgt' for target (english) vectors
+        :return: matrix of unit length sentence vectors, one row per sentence
+        """
+        if not sents:
+            return np.zeros((0, 0), dtype=np.float32)
+        word_vec = self.src_vec if side == 'src' else self.tgt_vec
+        vectors = bow([sent.lower().split() for sent in sents], word_vec)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (vectors / norms).astype(np.float32)
+
+    def score_pairs(self, src_sents, tgt_sents):
+        """
+        Scores many sentence pairs at once; each distinct sentence is embedded only once
+        :return: array of cosine similarities, same as score() on each pair
+        """
+        src_uniq = {sent: i for i, sent in enumerate(dict.fromkeys(src_sents))}
+        tgt_uniq = {sent: i for i, sent in enumerate(dict.fromkeys(tgt_sents))}
+        src_vecs = self.embed(list(src_uniq), side='src')
+        tgt_vecs = self.embed(list(tgt_uniq), side='tgt')
+        src_rows = src_vecs[[src_uniq[sent] for sent in src_sents]]
+        tgt_rows = tgt_vecs[[tgt_uniq[sent] for sent in tgt_sents]]
+        return np.einsum('ij,ij->i', src_rows, tgt_rows)
 
     def doc_score(self, src_sents, tgt_sents):
         """Compute the similarity between two documents i.e. two lists of sentences"""
@@ -95,9 +130,9 @@ class MCSS:
         tgt_merged = []
         for i in tgt_sents:
             tgt_merged += i.lower().split()
-        src_vectors = bow([tgt_merged], self.src_vec)
+        src_vectors = bow([src_merged], self.src_vec)
         tgt_vectors = bow([tgt_merged], self.tgt_vec)
-        return float(cosine_similarity(src_vectors, tgt_vectors))
+        return cosine(src_vectors[0], tgt_vectors[0])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,307 @@
+"""
+Cross document parallel sentence miner.
+
+Every segment of the source and english LTF directories is embedded into the MCSS space, an inverted file (IVF)
+index is built over the english segments, and the top-k neighbours of every source segment are rescored with the
+full scorer cascade from `scorer.get_scorer`. Only the mutually best pairs are emitted, so sentences which ended up
+in the wrong document are recovered too.
+"""
+import argparse
+import logging as log
+import multiprocessing as mp
+import os
+import sys
+from typing import Iterator, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from ltfreader import Corpus, load_corpus
+from scorer import get_scorer
+from utils import init_scorer, score_cands
+
+log.basicConfig(level=log.INFO)
+debug_mode = False
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search with cosine similarity.
+    Vectors are clustered with spherical k-means; a query only visits the `n_probe` closest clusters.
+    All vectors are kept in one contiguous array ordered by cluster, so each cluster is a single slice.
+    """
+
+    def __init__(self, n_lists=None, n_probe=16, dtype=np.float16, seed=0):
+        """
+        :param n_lists: number of clusters; default is 4 * sqrt(N)
+        :param n_probe: number of clusters to visit per query
+        :param dtype: storage type of the vectors, float16 halves the memory
+        :param seed: seed for the random state used in k-means
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.dtype = dtype
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    @staticmethod
+    def _normalize(mat):
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return mat / norms
+
+    def _assign(self, vectors, batch_size=65536):
+        """nearest centroid of each vector"""
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start: start + batch_size].astype(np.float32)
+            assign[start: start + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return assign
+
+    def train(self, vectors, iters=10, sample_per_list=64):
+        """
+        Learns the coarse quantizer (cluster centroids) from a sample of vectors
+        :param vectors: matrix of unit length vectors
+        :param iters: number of k-means iterations
+        :param sample_per_list: training sample size per cluster
+        """
+        n = len(vectors)
+        assert n > 0, 'Cannot train on zero vectors'
+        if not self.n_lists:
+            self.n_lists = int(4 * n ** 0.5)
+        self.n_lists = max(1, min(self.n_lists, n))
+        rng = np.random.RandomState(self.seed)
+        sample_size = min(n, self.n_lists * sample_per_list)
+        sample = vectors[np.sort(rng.choice(n, sample_size, replace=False))].astype(np.float32)
+        self.centroids = sample[rng.choice(sample_size, self.n_lists, replace=False)]
+        log.info(f"Training IVF index with {self.n_lists} lists on {sample_size} sample vectors")
+        for i in range(iters):
+            assign = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=self.n_lists)
+            empty = counts == 0
+            if empty.any():   # re-seed the empty clusters with random points
+                sums[empty] = sample[rng.choice(sample_size, empty.sum())]
+            self.centroids = self._normalize(sums).astype(np.float32)
+            log.debug(f"k-means iteration {i+1}: {empty.sum()} empty lists")
+        return self
+
+    def add(self, vectors, ids=None):
+        """
+        Adds vectors to the index. The index is (re)built as one contiguous array grouped by cluster
+        :param vectors: matrix of unit length vectors
+        :param ids: integer ids of the vectors; default is the row position
+        """
+        assert self.centroids is not None, 'Index must be trained before adding vectors'
+        ids = np.arange(len(vectors), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        assign = self._assign(vectors)
+        if self.ids is not None:    # merge with the existing ones
+            old_assign = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+            assign = np.concatenate([old_assign, assign])
+            vectors = np.concatenate([self.vectors, vectors.astype(self.dtype)])
+            ids = np.concatenate([self.ids, ids])
+        order = np.argsort(assign, kind='stable')
+        self.vectors = vectors[order].astype(self.dtype)
+        self.ids = ids[order]
+        self.offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=self.n_lists), out=self.offsets[1:])
+        return self
+
+    def search(self, queries, k=8) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the approximate top-k neighbours of the queries
+        :param queries: matrix of unit length query vectors
+        :param k: number of neighbours
+        :return: scores, ids ; both are of shape (num_queries, k) sorted by descending score.
+           id is -1 when fewer than k neighbours were found
+        """
+        queries = queries.astype(np.float32)
+        nq = len(queries)
+        top_scores = np.full((nq, k), -np.inf, dtype=np.float32)
+        top_ids = np.full((nq, k), -1, dtype=np.int64)
+        if nq == 0 or len(self) == 0:
+            return top_scores, top_ids
+        n_probe = min(self.n_probe, self.n_lists)
+        cent_sims = queries @ self.centroids.T
+        if n_probe < self.n_lists:
+            probes = np.argpartition(-cent_sims, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(self.n_lists), (nq, n_probe))
+        # group the queries by the lists they visit, so each list is scanned once per batch
+        list_ids = probes.ravel()
+        query_ids = np.repeat(np.arange(nq), n_probe)
+        order = np.argsort(list_ids, kind='stable')
+        list_ids, query_ids = list_ids[order], query_ids[order]
+        bounds = np.flatnonzero(np.diff(list_ids)) + 1
+        for group in np.split(np.arange(len(list_ids)), bounds):
+            list_id = list_ids[group[0]]
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            qs = query_ids[group]
+            sims = queries[qs] @ self.vectors[start:end].astype(np.float32).T
+            cand_scores = np.concatenate([top_scores[qs], sims], axis=1)
+            cand_ids = np.concatenate([top_ids[qs], np.broadcast_to(self.ids[start:end], sims.shape)], axis=1)
+            if cand_scores.shape[1] > k:
+                sel = np.argpartition(-cand_scores, k - 1, axis=1)[:, :k]
+                cand_scores = np.take_along_axis(cand_scores, sel, axis=1)
+                cand_ids = np.take_along_axis(cand_ids, sel, axis=1)
+            top_scores[qs], top_ids[qs] = cand_scores, cand_ids
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top_ids, order, axis=1)
+
+    def save(self, path):
+        log.info(f"Storing IVF index at {path}")
+        np.savez(path, centroids=self.centroids, vectors=self.vectors, ids=self.ids, offsets=self.offsets,
+                 n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path):
+        log.info(f"Loading IVF index from {path}")
+        data = np.load(path)
+        index = cls(n_lists=len(data['centroids']), n_probe=int(data['n_probe']), dtype=data['vectors'].dtype)
+        index.centroids, index.vectors = data['centroids'], data['vectors']
+        index.ids, index.offsets = data['ids'], data['offsets']
+        return index
+
+
+def seg_uid(corpus: Corpus, i: int) -> str:
+    """id of the i'th segment of the corpus, of the form doc_id.seg_id"""
+    return f'{corpus.seg_doc(i).doc_id}.{corpus.seg_id(i)}'
+
+
+def embed_all(mcss, corpus: Corpus, side, batch_size=10000, dtype=np.float16):
+    """Embeds all the segments of the corpus in batches; returns a matrix with one row per segment"""
+    vectors = None
+    for start in range(0, corpus.num_segs(), batch_size):
+        batch = mcss.embed(corpus.texts(start, start + batch_size), side=side)
+        if vectors is None:
+            vectors = np.empty((corpus.num_segs(), batch.shape[1]), dtype=dtype)
+        vectors[start: start + len(batch)] = batch
+    return vectors
+
+
+def mine(src_corpus: Corpus, eng_corpus: Corpus, index: IVFIndex, mcss, scorer, top_k=8, threshold=0.0,
+         batch_size=10000, threads=1) -> Iterator[Tuple[int, int, float]]:
+    """
+    Mines mutually best segment pairs
+    :param src_corpus: source documents
+    :param eng_corpus: english documents, their segments are the ones indexed in the index
+    :param index: IVF index of english segment vectors; ids are segment positions in eng_corpus
+    :param mcss: MCSS instance to embed the source segments
+    :param scorer: scorer for rescoring the candidates
+    :param top_k: number of candidates to retrieve per source segment
+    :param threshold: pairs scoring below this are dropped
+    :param batch_size: number of source segments to embed and search at once
+    :param threads: number of scoring processes
+    :return: iterator of (src_idx, eng_idx, score)
+    """
+    num_src, num_eng = src_corpus.num_segs(), eng_corpus.num_segs()
+    best_src_eng = np.full(num_src, -1, dtype=np.int64)
+    best_src_score = np.full(num_src, -np.inf, dtype=np.float32)
+    best_eng_src = np.full(num_eng, -1, dtype=np.int64)
+    best_eng_score = np.full(num_eng, -np.inf, dtype=np.float32)
+
+    pool = mp.Pool(threads, initializer=init_scorer, initargs=(scorer,)) if threads > 1 else None
+    init_scorer(scorer)
+    try:
+        for start in range(0, num_src, batch_size):
+            batch = src_corpus.texts(start, start + batch_size)
+            _, cand_ids = index.search(mcss.embed(batch, side='src'), k=top_k)
+            cands = [(start + i, int(eng_idx), src_txt, eng_corpus.text(eng_idx))
+                     for i, (src_txt, row) in enumerate(zip(batch, cand_ids)) for eng_idx in row if eng_idx >= 0]
+            if pool:
+                chunk = max(1, len(cands) // (4 * threads))
+                chunks = [cands[i: i + chunk] for i in range(0, len(cands), chunk)]
+                scored = (rec for res in pool.imap(score_cands, chunks) for rec in res)
+            else:
+                scored = score_cands(cands)
+            for src_idx, eng_idx, score in scored:
+                if score < threshold:
+                    continue
+                if score > best_src_score[src_idx]:
+                    best_src_score[src_idx], best_src_eng[src_idx] = score, eng_idx
+                if score > best_eng_score[eng_idx]:
+                    best_eng_score[eng_idx], best_eng_src[eng_idx] = score, src_idx
+            log.info(f"Searched {min(start + batch_size, num_src)} of {num_src} source segments")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    for src_idx, eng_idx in enumerate(best_src_eng):
+        if eng_idx >= 0 and best_eng_src[eng_idx] == src_idx:
+            yield src_idx, int(eng_idx), float(best_src_score[src_idx])
+
+
+def main(found_dir, src_lang, out, flags, top_k, n_lists, n_probe, threshold, batch_size, threads,
+         index_path=None, **args):
+    from mcss import MCSS
+    assert args['src_emb'] and args['eng_emb'], '--src-emb and --eng-emb are required for embedding segments'
+    mcss = MCSS(src_vec_path=args['src_emb'], tgt_vec_path=args['eng_emb'], nmax=args['max_vocab'])
+    src_corpus = load_corpus(f'{found_dir}/{src_lang}/ltf')
+    eng_corpus = load_corpus(f'{found_dir}/eng/ltf')
+    log.info(f"Loaded {src_corpus.num_segs()} source and {eng_corpus.num_segs()} english segments")
+
+    if index_path and os.path.exists(index_path):
+        index = IVFIndex.load(index_path)
+        index.n_probe = n_probe
+        assert len(index) == eng_corpus.num_segs(), f'{index_path} is stale; it has {len(index)} vectors'
+    else:
+        eng_vecs = embed_all(mcss, eng_corpus, side='tgt', batch_size=batch_size)
+        index = IVFIndex(n_lists=n_lists, n_probe=n_probe).train(eng_vecs).add(eng_vecs)
+        del eng_vecs
+        if index_path:
+            index.save(index_path)
+
+    scorer = get_scorer(flags, debug=debug_mode, mcss=mcss, threshold=threshold, **args)
+    count = 0
+    for src_idx, eng_idx, score in mine(src_corpus, eng_corpus, index, mcss, scorer, top_k=top_k, threshold=threshold,
+                                        batch_size=batch_size, threads=threads):
+        out.write(f'{seg_uid(src_corpus, src_idx)}\t{seg_uid(eng_corpus, eng_idx)}\t{score:.4f}\n')
+        count += 1
+    log.info(f"Mined {count} segment pairs")
+
+
+if __name__ == '__main__':
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-fd', '--found-dir', type=str, required=True,
+                   help='Path to "found" dir that has eng and xyz lan')
+    p.add_argument('-l', '--lang', dest='src_lang', type=str, required=True, help='source language code')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
+                   help='Output file. Format: src_doc.seg_id<tab>eng_doc.seg_id<tab>score')
+    p.add_argument('-f', '--flags', type=str, default='charlen,toklen,copypatn,ascii,mcss',
+                   help='comma separated list of scorers to rescore the candidates. See realigner.py')
+    p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+    p.add_argument('-th', '--threshold', type=float, default=0.0,
+                   help='threshold score below which the sentence pairs must be ignored')
+    p.add_argument('-nt', '--threads', type=int, default=2, help='Number of processes for rescoring')
+    p.add_argument('-k', '--top-k', type=int, default=8, help='Number of candidates to retrieve per source segment')
+    p.add_argument('-nl', '--n-lists', type=int, help='Number of IVF lists (clusters). Default: 4 * sqrt(N)')
+    p.add_argument('-np', '--n-probe', type=int, default=16, help='Number of IVF lists to visit per query')
+    p.add_argument('-bs', '--batch-size', type=int, default=10000, help='Number of segments to embed at once')
+    p.add_argument('-ix', '--index', dest='index_path', type=str,
+                   help='Store the english index at this path (.npz) and reuse it in the later runs')
+
+    p.add_argument('-se', '--src-emb', type=str, required=True, help='path to source language embedding')
+    p.add_argument('-ee', '--eng-emb', type=str, required=True, help='path to english language embedding')
+    p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size')
+    p.add_argument('-tf', '--ttab-file', type=str, help='Path to ttab file (flag=ttab)')
+    p.add_argument('-sc', '--score-cache', type=str,
+                   help='Cache the scores of the sentence pairs in this file, and reuse them (see scorecache.py)')
+
+    args = vars(p.parse_args())
+    if args.pop('debug'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+        log.debug("Debug Mode ON")
+    main(**args)
+    log.info("Done.")
@@ -1,20 +1,21 @@
 # Author :  Thamme Gowda ;; Created : July 04, 2018
 
 import argparse
-import glob
 import itertools
 import logging as log
 import os
 import sys
-import lxml.etree as et
 from collections import OrderedDict
-from typing import List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional
 import multiprocessing as mp
+import multiprocessing.util as mp_util
+import gzip
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 from ltfreader import read_ltf_doc, Doc
-from scorer import get_scorer
-from ttab import TTable, Preprocessor
+import alnreader
+import vfs
+from scorer import get_scorer, warm_up_cascade
 
 log.basicConfig(level=log.INFO)
 debug_mode = False
@@ -28,22 +29,16 @@ class Alignment:
         self.alignments = alignments
 
 
-def read_doc_id_mapping(aln_file):
-    aln_el = et.parse(aln_file).getroot()
-    return aln_el.attrib["source_id"], aln_el.attrib["translation_id"]
-
-
-def read_doc_alignments(aln_dir):
-    aln_files = glob.glob(f'{aln_dir}/*.aln.xml')
-
-    for i, f in enumerate(aln_files):
-        if debug_mode and i == 50:
-            log.warning("Aborting early in debug mode")
-            break
-        yield read_doc_id_mapping(f)
+def read_doc_alignments(aln_dir, use_cache=True):
+    aln_maps = alnreader.read_doc_alignments(aln_dir, use_cache=use_cache)
+    if debug_mode and len(aln_maps) > 50:
+        log.warning("Aborting early in debug mode")
+        aln_maps = aln_maps[:50]
+    return aln_maps
 
 
 def write_alignment(path: str, aln: Alignment, swap=True):
+    import lxml.etree as et
     log.info(f"Writing alignment file {path}")
     root = et.Element("alignments")
     if swap:
@@ -68,14 +63,56 @@ def write_alignment(path: str, aln: Alignment, swap=True):
     tree.write(path, pretty_print=True)
 
 
-def re_align_segs(src_doc: Doc, eng_doc: Doc, scorer, threshold=0.0) -> Optional[Alignment]:
+_bitext_shards = {}   # bitext path -> shard file of this process
+
+
+def bitext_shard(path: str):
+    """
+    Opens this worker's shard of a bitext file, for example bitext.tsv.gz -> bitext.tsv.3.gz for worker 3.
+    Shards are opened once per process and closed when the process exits
+    """
+    out = _bitext_shards.get(path)
+    if out is None:
+        shard = mp.current_process().name.split('-')[-1]
+        base, ext = (path[:-3], '.gz') if path.endswith('.gz') else (path, '')
+        shard_path = f'{base}.{shard}{ext}'
+        log.info(f"Writing bitext to {shard_path}")
+        out = gzip.open(shard_path, 'at', encoding='utf-8') if ext else open(shard_path, 'a', encoding='utf-8')
+        mp_util.Finalize(out, out.close, exitpriority=10)
+        _bitext_shards[path] = out
+    return out
+
+
+def write_bitext(out, aln: Alignment, src_doc: Doc, eng_doc: Doc):
+    """Writes src_id<tab>tgt_id<tab>score<tab>src_text<tab>tgt_text per aligned segment"""
+    for src_sids, tgt_sids, score in aln.alignments:
+        src_id = ' '.join(f'{src_doc.doc_id}.{sid}' for sid in src_sids)
+        tgt_id = ' '.join(f'{eng_doc.doc_id}.{sid}' for sid in tgt_sids)
+        src_txt = ' '.join(src_doc.get_seg(sid) for sid in src_sids)
+        tgt_txt = ' '.join(eng_doc.get_seg(sid) for sid in tgt_sids)
+        out.write(f'{src_id}\t{tgt_id}\t{score:.4f}\t{src_txt}\t{tgt_txt}\n')
 
+
+def score_segs(src_doc: Doc, eng_doc: Doc, scorer) -> Dict[Tuple[str, str], float]:
+    """Scores all the (source, english) segment pairs of the two docs"""
     srcs, tgts = src_doc.get_segs(), eng_doc.get_segs()
+    if hasattr(scorer, 'score_matrix'):     # a scoring server; the whole doc pair in one request
+        matrix = scorer.score_matrix([txt for _, txt in srcs], [txt for _, txt in tgts])
+        return {(src_sid, tgt_sid): score for (src_sid, _), row in zip(srcs, matrix)
+                for (tgt_sid, _), score in zip(tgts, row)}
     scores = {}
     for (src_sid, src_txt), (tgt_sid, tgt_txt) in itertools.product(srcs, tgts):
         # TODO: skip if texts are not compatible
         scores[(src_sid, tgt_sid)] = scorer.score(src_txt, tgt_txt)
+    return scores
+
 
+def greedy_match(scores: Dict[Tuple[str, str], float], threshold=0.0):
+    """
+    Matches the highest scoring pairs first; a segment is matched at most once
+    :return: (fwd_matching, rev_matching); src_sid -> (tgt_sid, score) in the descending order of scores, and
+       tgt_sid -> (src_sid, score)
+    """
     # Rev sort by scores
     items = [entry for entry in scores.items() if entry[1] >= threshold]
     items = sorted(items, key=lambda x: x[1], reverse=True)
@@ -84,6 +121,13 @@ def re_align_segs(src_doc: Doc, eng_doc: Doc, scorer, threshold=0.0) -> Optional
         if id1 not in fwd_matching and id2 not in rev_matching:
             fwd_matching[id1] = id2, score
             rev_matching[id2] = id1, score
+    return fwd_matching, rev_matching
+
+
+def re_align_segs(src_doc: Doc, eng_doc: Doc, scorer, threshold=0.0) -> Optional[Alignment]:
+
+    scores = score_segs(src_doc, eng_doc, scorer)
+    fwd_matching, rev_matching = greedy_match(scores, threshold)
     if debug_mode:
         src_sids, tgt_sids = zip(*scores.keys())
         missed_src = src_sids - fwd_matching.keys()
@@ -105,8 +149,9 @@ def re_align_segs(src_doc: Doc, eng_doc: Doc, scorer, threshold=0.0) -> Optional
 
 class ReAlignTask:
     """For multi processing"""
-    def __init__(self, found_dir, out_dir, scorer, threshold):
+    def __init__(self, found_dir, out_dir, scorer, threshold, out_bitext=None):
         self.out_dir = out_dir
+        self.out_bitext = out_bitext
         self.found_dir = found_dir
         self.scorer = scorer
         self.threshold = threshold
@@ -118,68 +163,150 @@ class ReAlignTask:
     def aln_path(self, doc_id):
         return f'{self.out_dir}/{doc_id}.aln.xml'
 
-    def run(self, ids):
-        """ For the sake of prarallelization"""
+    @staticmethod
+    def order_ids(ids):
+        """(source_id, english_id) irrespective of the order in the mapping"""
         src_id, eng_id = ids
         if src_id.lower().startswith('eng'):  # if swapping needed
             src_id, eng_id = eng_id, src_id
+        return src_id, eng_id
 
-        out_path = self.aln_path(eng_id)
-        if os.path.exists(out_path):
-            log.info(f'Skip: {src_id} x {eng_id} :: File exists {out_path}')
-            return
+    def align(self, ids) -> Optional[Alignment]:
+        src_id, eng_id = self.order_ids(ids)
         log.info(f"Going to align {src_id} x {eng_id}")
         src_doc = read_ltf_doc(self.ltf_path(src_id))
         eng_doc = read_ltf_doc(self.ltf_path(eng_id))
         new_algn = re_align_segs(src_doc, eng_doc, self.scorer, self.threshold)
+        if not new_algn:
+            log.warning(f'{src_id} x {eng_id} :: No alignment possible')
+        elif self.out_bitext:
+            write_bitext(bitext_shard(self.out_bitext), new_algn, src_doc, eng_doc)
+        return new_algn
+
+    def run(self, ids):
+        """ For the sake of prarallelization"""
+        src_id, eng_id = self.order_ids(ids)
+        out_path = self.aln_path(eng_id)
+        if os.path.exists(out_path):
+            log.info(f'Skip: {src_id} x {eng_id} :: File exists {out_path}')
+            return
+        new_algn = self.align((src_id, eng_id))
         if new_algn:
             write_alignment(out_path, new_algn, swap=True)
-        else:
-            log.warning(f'{src_id} x {eng_id} :: No alignment possible')
 
 
-def re_align_all(doc_mapping: List[Tuple[str, str]], found_dir, out_dir, scorer, threshold, threads=2):
+def seg_pairs(found_dir, doc_mapping: List[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+    """(source text, english text) of all the segment pairs of the document pairs, in the order of the mapping"""
+    task = ReAlignTask(found_dir, out_dir=None, scorer=None, threshold=0.0)
+    for ids in doc_mapping:
+        src_id, eng_id = task.order_ids(ids)
+        src_doc, eng_doc = read_ltf_doc(task.ltf_path(src_id)), read_ltf_doc(task.ltf_path(eng_id))
+        for (_, src_txt), (_, eng_txt) in itertools.product(src_doc.get_segs(), eng_doc.get_segs()):
+            yield src_txt, eng_txt
+
+
+def re_align_all(doc_mapping: List[Tuple[str, str]], found_dir, out_dir, scorer, threshold, threads=2,
+                 out_store=None, out_bitext=None):
+    """
+    Re-aligns all the document pairs.
+    :param out_store: if given, alignments are appended to this alignment store (see alnstore.py) by a single
+      writer instead of writing one aln.xml file per document into out_dir
+    :param out_bitext: if given, each worker also writes the aligned text to its own shard of this path
+    """
     assert threshold <= 1
     log.info(f"Going to use {threads} threads")
     task_pool = mp.Pool(threads)
-    task = ReAlignTask(found_dir, out_dir, scorer, threshold)
-    task_pool.map(task.run, doc_mapping)
+    task = ReAlignTask(found_dir, out_dir, scorer, threshold, out_bitext=out_bitext)
+    if out_store:
+        from alnstore import AlignmentWriter, read_done
+        done = read_done(out_store)
+        todo = [ids for ids in map(task.order_ids, doc_mapping) if ids not in done]
+        log.info(f"Skip: {len(doc_mapping) - len(todo)} doc pairs are already in {out_store}")
+        with AlignmentWriter(out_store) as writer:
+            for new_algn in task_pool.imap_unordered(task.align, todo):
+                if new_algn:
+                    writer.write(new_algn)
+    else:
+        task_pool.map(task.run, doc_mapping)
     task_pool.close()
     task_pool.join()
     log.info("Exiting...")
 
 
-def main(found_dir, src_lang, out_dir, flags, old_aln_dir='sentence_alignment.old', **args):
-    subs = os.listdir(found_dir)
+def main(found_dir, src_lang, out_dir, flags, old_aln_dir='sentence_alignment.old', discover=False,
+         compile_cache=False, no_cache=False, out_store=None, out_bitext=None, **args):
+    subs = vfs.listdir(found_dir)
     assert 'eng' in subs
     assert src_lang in subs
-    assert old_aln_dir in subs
-
-    aln_dir = f'{found_dir}/{old_aln_dir}'
-    if '/' not in out_dir:
-        out_dir = f'{found_dir}/{out_dir}'
-    log.info(f"Output dir {out_dir}")
-    os.makedirs(out_dir, exist_ok=True)
-    aln_maps = list(read_doc_alignments(aln_dir))
+    if not discover and old_aln_dir not in subs:
+        log.warning(f"{old_aln_dir} not found in {found_dir}; going to discover the document pairs")
+        discover = True
+
+    if compile_cache and vfs.in_archive(found_dir):
+        # the caches are memory mapped files next to the LTF dirs, which an archive can not have
+        log.warning(f"{found_dir} is in an archive; the LTF caches are not compiled, nor used")
+    elif compile_cache:
+        from ltfcache import compile_dir
+        for lang in (src_lang, 'eng'):
+            compile_dir(f'{found_dir}/{lang}/ltf')
+
+    if out_store:
+        log.info(f"Output store {out_store}")
+    else:
+        if '/' not in out_dir:
+            archive, _ = vfs.split_archive(found_dir)
+            # archives are read only, so the output goes next to the archive
+            out_dir = f'{os.path.dirname(archive)}/{out_dir}' if archive else f'{found_dir}/{out_dir}'
+        log.info(f"Output dir {out_dir}")
+        os.makedirs(out_dir, exist_ok=True)
+    if discover:
+        from docmatcher import discover_doc_pairs
+        mcss = None
+        if args.get('src_emb') and args.get('eng_emb'):
+            from mcss import MCSS
+            mcss = MCSS(src_vec_path=args['src_emb'], tgt_vec_path=args['eng_emb'], nmax=args['max_vocab'])
+            args['mcss'] = mcss     # reuse for scoring too
+        aln_maps = discover_doc_pairs(found_dir, src_lang, mcss=mcss)
+    else:
+        aln_maps = read_doc_alignments(f'{found_dir}/{old_aln_dir}', use_cache=not no_cache)
     log.info(f"Found {len(aln_maps)} doc mappings")
     scorer = get_scorer(flags, debug=debug_mode, **args)
+    if args.get('adapt_cascade'):   # once, here, so that all the workers score in the same order
+        warm_up_cascade(scorer, seg_pairs(found_dir, aln_maps), flags, **args)
     re_align_all(aln_maps, found_dir=found_dir, out_dir=out_dir, scorer=scorer,
-                 threshold=args['threshold'], threads=args['threads'])
+                 threshold=args['threshold'], threads=args['threads'], out_store=out_store,
+                 out_bitext=out_bitext)
 
 
 if __name__ == '__main__':
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument('-fd', '--found-dir', type=str, required=True,
                    help='Path to "found" dir that has eng and xyz lan')
     p.add_argument('-l', '--lang', dest='src_lang', type=str, required=True, help='source language code')
     p.add_argument('-o', '--out-dir', type=str, default='sentence_alignment-ttab',
                    help='Create new alignments files inside this directory')
+    p.add_argument('-os', '--out-store', type=str,
+                   help='Append all the alignments to this single JSONL file (.gz for compressed) instead of'
+                        ' writing one file per document to --out-dir. See alnstore.py to export aln.xml files')
+    p.add_argument('-ob', '--out-bitext', type=str,
+                   help='Also write the aligned text while aligning: src_id<tab>tgt_id<tab>score<tab>src<tab>tgt'
+                        ' per line. One shard per worker, e.g. bitext.tsv.gz -> bitext.tsv.<worker>.gz')
     p.add_argument('-f', '--flags', type=str, default='charlen,toklen,copypatn,ascii,ttab',
                    help='comma separated list of scorers to use.'
                         ' For example set -f "mcss" to use only MCSS or'
                         ' "copypatn,mcss" to use copy pattern scorer and MCSS or'
                         ' "ttab" to use t-table scorer')
     p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+    p.add_argument('--discover', action='store_true',
+                   help='Discover the document pairs instead of reading them from sentence_alignment.old.'
+                        ' This is implied when sentence_alignment.old does not exist.'
+                        ' Uses --src-emb and --eng-emb if they are given')
+    p.add_argument('-cc', '--compile-cache', action='store_true',
+                   help='(Re)compile the binary caches of the LTF dirs before aligning (see ltfcache.py).'
+                        ' Existing fresh caches are used even without this flag')
+    p.add_argument('--no-cache', action='store_true',
+                   help='Do not use the cache of the document mappings of the previous runs (see alnreader.py)')
     p.add_argument('-th', '--threshold', type=float, default=0.0,
                    help='threshold score below which the sentence pairs must be ignored')
     p.add_argument('-nt', '--threads', type=int, default=2, help='Number of threads to use')
@@ -188,6 +315,18 @@ if __name__ == '__main__':
     p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (flag=mcss)')
     p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size (flag=mcss)')
     p.add_argument('-tf', '--ttab-file', type=str, help='Path to ttab file (flag=ttab)')
+    p.add_argument('-sw', '--scorer-weights', type=str,
+                   help='Weights of the scorers to combine, e.g. "mcss:2,ttab:1" (flags=mcss,ttab). Default: equal')
+    p.add_argument('-sc', '--score-cache', type=str,
+                   help='Cache the scores of the sentence pairs in this file, and reuse them (see scorecache.py)')
+    p.add_argument('-srv', '--server', type=str,
+                   help='Score with a running scoreserver.py at this Unix socket path or host:port, instead of'
+                        ' loading the models here')
+    p.add_argument('-co', '--cascade-order', type=str,
+                   help='Order of the heuristics: comma separated flags, or a file saved by scorer.py --export-cascade')
+    p.add_argument('-ac', '--adapt-cascade', type=int, default=0,
+                   help='Measure the heuristics on these many segment pairs of the first documents, then reorder'
+                        ' them to the least expected cost, before aligning')
 
     args = vars(p.parse_args())
     if args.pop('debug'):
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Streaming sentence re-matcher for large score files.
+
+Reads doc_id.seg_id<tab>doc_id.seg_id<tab>score records in any order, groups them by the source document with
+an on-disk external sort/merge, and re-matches the segments of each document greedily, like
+scratch/realign.old.py does. Only the top-k targets of each source segment are kept in heaps, so the memory is
+bounded by the chunk size of the sort and by k x (segments in a document), not by the input size.
+"""
+import argparse
+import heapq
+import itertools
+import logging as log
+import os
+import sys
+import tempfile
+from collections import OrderedDict, namedtuple
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+log.basicConfig(level=log.INFO)
+debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
+
+Match = namedtuple('Match', ['src', 'tgt', 'score'])
+Record = Tuple[str, str, float]
+
+
+def doc_key(rec: Record) -> str:
+    return rec[0].split('.')[0]
+
+
+def parse_records(lines: Iterable[str], threshold: Optional[float] = None) -> Iterator[Record]:
+    """Parses the input lines; records scoring below the threshold are dropped right away"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        src_id, tgt_id, score = map(lambda x: x.strip(), line.split('\t'))
+        score = float(score)
+        if threshold is None or score >= threshold:
+            yield src_id, tgt_id, score
+
+
+def _write_run(recs: Iterable[Record], tmp_dir: str) -> str:
+    fd, path = tempfile.mkstemp(prefix='run-', suffix='.tsv', dir=tmp_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8', buffering=1 << 20) as out:
+        for src_id, tgt_id, score in recs:
+            out.write(f'{src_id}\t{tgt_id}\t{score!r}\n')
+    return path
+
+
+def _read_run(path: str) -> Iterator[Record]:
+    with open(path, encoding='utf-8', buffering=1 << 20) as inp:
+        for line in inp:
+            src_id, tgt_id, score = line.rstrip('\n').split('\t')
+            yield src_id, tgt_id, float(score)
+    os.remove(path)
+
+
+def external_sort(recs: Iterable[Record], tmp_dir: str, chunk_size=1_000_000, fan_in=128) -> Iterator[Record]:
+    """
+    Sorts records by document id using sorted runs on disk
+    :param recs: records in any order
+    :param tmp_dir: directory for the runs
+    :param chunk_size: number of records to sort in memory at once
+    :param fan_in: maximum number of runs to merge at once
+    :return: records grouped (sorted) by the document id
+    """
+    runs, recs = [], iter(recs)
+    while True:
+        chunk = list(itertools.islice(recs, chunk_size))
+        if not chunk:
+            break
+        chunk.sort(key=doc_key)
+        if not runs and len(chunk) < chunk_size:   # everything fits in memory, no need for disk
+            yield from chunk
+            return
+        runs.append(_write_run(chunk, tmp_dir))
+        log.info(f"Sorted run {len(runs)} of {len(chunk)} records")
+    while len(runs) > fan_in:   # merge in multiple passes to limit the number of open files
+        merged = heapq.merge(*map(_read_run, runs[:fan_in]), key=doc_key)
+        runs = runs[fan_in:] + [_write_run(merged, tmp_dir)]
+    yield from heapq.merge(*map(_read_run, runs), key=doc_key)
+
+
+def rematch(doc_id: str, recs: Iterable[Record], top_k: Optional[int] = 10) -> List[Match]:
+    """
+    Rematch sentences within a document based on the scores
+    :param doc_id: id of the document, for logging
+    :param recs: all the records of the document
+    :param top_k: number of best targets to remember per source segment. None to keep all, which gives the exact
+       greedy matching of realign.old.py
+    :return: matches in the descending order of the scores
+    """
+    heaps, tgt_ids = {}, set()
+    for src_id, tgt_id, score in recs:
+        tgt_ids.add(tgt_id)
+        heap = heaps.setdefault(src_id, [])
+        if top_k is None or len(heap) < top_k:
+            heapq.heappush(heap, (score, tgt_id))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, tgt_id))
+    items = sorted(((score, src_id, tgt_id) for src_id, heap in heaps.items() for score, tgt_id in heap),
+                   key=lambda x: x[0], reverse=True)
+    fwd_matching, rev_matching = OrderedDict(), set()
+    for score, src_id, tgt_id in items:
+        if src_id not in fwd_matching and tgt_id not in rev_matching:
+            fwd_matching[src_id] = tgt_id, score
+            rev_matching.add(tgt_id)
+    if debug_mode:
+        missed_src = heaps.keys() - fwd_matching.keys()
+        if missed_src:
+            log.debug(f'Document: {doc_id}, Source side missed alignment for {missed_src}')
+        missed_tgt = tgt_ids - rev_matching
+        if missed_tgt:
+            log.debug(f'Document: {doc_id}, Target side missed alignment for {missed_tgt}')
+    return [Match(src, tgt, score) for src, (tgt, score) in fwd_matching.items()]
+
+
+def realign_segments(recs: Iterable[Record], top_k: Optional[int] = 10, chunk_size=1_000_000,
+                     tmp_dir: Optional[str] = None) -> Iterator[Match]:
+    """
+    :param recs: records in any order
+    :param top_k: see rematch()
+    :param chunk_size: see external_sort()
+    :param tmp_dir: parent directory for the temporary sorted runs
+    :return: matches, document by document
+    """
+    count = 0
+    with tempfile.TemporaryDirectory(prefix='rematcher-', dir=tmp_dir) as run_dir:
+        for doc_id, doc_recs in itertools.groupby(external_sort(recs, run_dir, chunk_size=chunk_size), key=doc_key):
+            count += 1
+            yield from rematch(doc_id, doc_recs, top_k=top_k)
+    log.info(f"Processed {count} docs")
+
+
+def main(inp, out, threshold, top_k, chunk_size, tmp_dir):
+    line_count = 0
+    recs = parse_records(inp, threshold)
+    for rec in realign_segments(recs, top_k=top_k if top_k > 0 else None, chunk_size=chunk_size, tmp_dir=tmp_dir):
+        out.write(f'{rec.src}\t{rec.tgt}\t{rec.score:.4f}\n')
+        line_count += 1
+    log.info(f"Wrote {line_count} segments to output")
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-i', '--inp', type=argparse.FileType('r'), default=sys.stdin,
+                   help='Input file having one record per line. Format: doc_id.seg_id<tab>doc_id.seg_id<tab>score.'
+                        'Score must be a floating point number, higher value signifies better match.'
+                        ' Records need not be sorted or grouped')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
+                   help='Output file')
+    p.add_argument('-t', '--threshold', type=float, default=0.0,
+                   help='Threshold value: ignore records with scores lower than this')
+    p.add_argument('-k', '--top-k', type=int, default=10,
+                   help='Number of best targets to keep per source segment. 0 to keep all (exact, more memory)')
+    p.add_argument('-cs', '--chunk-size', type=int, default=1_000_000,
+                   help='Number of records to sort in memory before spilling to disk')
+    p.add_argument('-td', '--tmp-dir', type=str, help='Directory for the temporary sorted runs')
+    p.add_argument('-v', '--verbose', action='store_true', help='verbose mode')
+    args = vars(p.parse_args())
+    if args.pop('verbose'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+
+    main(**args)
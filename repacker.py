@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Repacks ELISA XML into SRC_ID<tab>TGT_ID<tab>SRC<tab>TGT records, as per a new segment alignment.
+
+Unlike scratch/repacker.old.py, which buffers values and can only resolve the targets seen before their source,
+this works in two passes over the file:
+  1. the byte offsets of the SEGMENT elements whose target is in the mapping are indexed
+  2. the segments are streamed again in order; a source mapped to another target gets its value by seeking to
+     the offset of that segment
+A gzip input is read through vfs.SeekableGzip, whose decompressor checkpoints from the first pass serve as the
+block index for the seeks of the second. Memory grows with the mapping, not with the file.
+"""
+import argparse
+import builtins
+import logging as log
+import re
+import sys
+from typing import BinaryIO, Dict, Iterator, TextIO, Tuple
+
+import lxml.etree as et
+
+from vfs import SeekableGzip
+
+log.basicConfig(level=log.INFO)
+debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
+
+seg_pat = re.compile(rb'<SEGMENT[\s>].*?</SEGMENT>', re.S)
+src_id_pat = re.compile(rb'<SOURCE\b[^>]*?\sid\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+tgt_id_pat = re.compile(rb'<TARGET\b[^>]*?\sid\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def read_alignment(inp: TextIO) -> Dict[str, str]:
+    """Reads alignment file into a dictionary"""
+    recs = (line.strip().split('\t')[:2] for line in inp)
+    recs = (tuple(col.strip() for col in row) for row in recs)
+    return {k: v for k, v in recs}
+
+
+def open_xml(path: str, spacing: int, points=None) -> BinaryIO:
+    if path.endswith('.gz'):
+        return SeekableGzip(path, spacing=spacing, points=points)
+    return builtins.open(path, 'rb')
+
+
+def iter_segments(inp: BinaryIO, chunk_size=1 << 20) -> Iterator[Tuple[int, bytes]]:
+    """
+    Finds the SEGMENT elements by scanning the bytes, without parsing the XML
+    :return: (byte offset, bytes of the element)
+    """
+    buf, base, eof = bytearray(), inp.tell(), False
+    while True:
+        match = seg_pat.search(buf)
+        if match:
+            yield base + match.start(), bytes(match.group())
+            del buf[:match.end()]
+            base += match.end()
+            continue
+        if eof:
+            break
+        start = buf.rfind(b'<SEGMENT')   # drop the bytes that can never be a part of a segment
+        drop = start if start >= 0 else max(0, len(buf) - len(b'<SEGMENT'))
+        del buf[:drop]
+        base += drop
+        chunk = inp.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
+
+def _seg_id(pat, seg: bytes) -> str:
+    match = pat.search(seg)
+    assert match, f'Id not found in {seg[:200]}'
+    return (match.group(1) or match.group(2)).decode('utf-8')
+
+
+def _field(seg: bytes, field: str) -> str:
+    return et.fromstring(seg).xpath(f'.//{field}/text()')[0]
+
+
+def re_align(elisa_xml: str, out: TextIO, mapping: Dict[str, str],
+             src_field: str = 'ULF_LRLP_TOKENIZED_SOURCE',
+             tgt_field: str = 'ULF_LRLP_TOKENIZED_TARGET',
+             block_size: int = 16):
+    """
+    :param elisa_xml: path to ELISA XML file, optionally gzip compressed
+    :param out: output stream
+    :param mapping: source segment id -> target segment id
+    :param src_field: name of the source field
+    :param tgt_field: name of the target field
+    :param block_size: MBs of uncompressed data between the gzip checkpoints
+    """
+    src2tgt = mapping
+    tgt2src = {t: s for s, t in src2tgt.items()}
+    assert len(src2tgt) == len(tgt2src)
+    spacing = block_size * 1024 * 1024
+
+    tgt_index: Dict[str, Tuple[int, int]] = {}    # target id -> (offset, length) of the segment
+    with open_xml(elisa_xml, spacing) as inp:
+        total = 0
+        for offset, seg in iter_segments(inp):
+            total += 1
+            tgt_id = _seg_id(tgt_id_pat, seg)
+            if tgt_id in tgt2src:
+                tgt_index[tgt_id] = offset, len(seg)
+        points = getattr(inp, 'points', None)
+    log.info(f"Indexed {len(tgt_index)} of {total} segments")
+
+    count, remap_count, skip_count = 0, 0, 0
+    with open_xml(elisa_xml, spacing) as inp, open_xml(elisa_xml, spacing, points=points) as lookup:
+        for _, seg in iter_segments(inp):
+            src_id, tgt_id = _seg_id(src_id_pat, seg), _seg_id(tgt_id_pat, seg)
+            if src_id in src2tgt:
+                mapped_tgt_id = src2tgt[src_id]
+                if mapped_tgt_id == tgt_id:      # matching is not changed
+                    tgt_val = _field(seg, tgt_field)
+                elif mapped_tgt_id in tgt_index:
+                    log.debug(f" {src_id} --> {mapped_tgt_id} (old: {tgt_id}) ")
+                    offset, length = tgt_index[mapped_tgt_id]
+                    lookup.seek(offset)
+                    tgt_val = _field(lookup.read(length), tgt_field)
+                    remap_count += 1
+                else:
+                    log.warning(f"Skip : {src_id}; its target {mapped_tgt_id} is not in {elisa_xml}")
+                    skip_count += 1
+                    continue
+                tgt_id = mapped_tgt_id
+            elif tgt_id in tgt2src:
+                continue    # written along with the source it is mapped to
+            else:
+                tgt_val = _field(seg, tgt_field)
+            src_val = _field(seg, src_field)
+            out.write(f'{src_id}\t{tgt_id}\t{src_val}\t{tgt_val}\n')
+            count += 1
+    log.info(f"Wrote {count} records to output, {remap_count} of them remapped. Skipped {skip_count} records")
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-e', '--elisa-xml', type=str, required=True,
+                   help='elisa xml file, optionally gzip compressed (.gz)')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
+                   help='Output file')
+    p.add_argument('-a', '--alignment', type=argparse.FileType('r'), required=True,
+                   help="Path to alignment file. Format=SRC_ID<tab>TGT_ID")
+    p.add_argument('-s', '--src-field', type=str, default='ULF_LRLP_TOKENIZED_SOURCE', help='Source Field')
+    p.add_argument('-t', '--tgt-field', type=str, default='ULF_LRLP_TOKENIZED_TARGET', help='Target Field')
+    p.add_argument('-bs', '--block-size', type=int, default=16,
+                   help='MBs of uncompressed data between the seek points of a gzip input')
+
+    args = vars(p.parse_args())
+    matching = read_alignment(args.pop('alignment'))
+    re_align(mapping=matching, **args)
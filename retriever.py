@@ -0,0 +1,229 @@
+"""
+Solr backed candidate retrieval for cross document alignment.
+
+The segments indexed by `ltfreader.index_docs` (fields: id, doc_id, seg_id, text, lang, position, corpus) are
+queried with the copy tokens (numbers and URLs) of each source segment, and with t-table translations of its
+rarest tokens. Several source segments are grouped into one Solr request (a disjunction of all their terms);
+the hits are given back to the source segments they share terms with. Requests are run concurrently over the
+pooled session of `solr.Solr`, and the candidates are rescored with the scorer from `scorer.get_scorer`.
+Each source segment is scored against a handful of candidates, never against all the english segments.
+"""
+import argparse
+import logging as log
+import multiprocessing as mp
+import os
+import re
+import sys
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from ltfreader import read_ltf_dir
+from scorer import UnifiedScorer, get_scorer
+from utils import init_scorer, score_cands
+
+log.basicConfig(level=log.INFO)
+debug_mode = False
+
+Seg = Tuple[str, str]   # (id, text)
+_special_chars = re.compile(r'([\\"])')
+
+
+class QueryBuilder:
+    """Builds the query terms of a source segment"""
+
+    def __init__(self, ttab=None, n_rare=3, n_trans=3, lowercase=True):
+        """
+        :param ttab: TTable to translate the source tokens (optional); without it, only copy tokens are used
+        :param n_rare: number of the rarest (by t-table vocabulary frequency) source tokens to translate
+        :param n_trans: number of the most probable translations per token
+        :param lowercase: lowercase the terms; the text field of Solr is expected to be case insensitive
+        """
+        self.ttab = ttab
+        self.n_rare = n_rare
+        self.n_trans = n_trans
+        self.lowercase = lowercase
+
+    def copy_terms(self, text: str) -> Set[str]:
+        return {tok for pat in UnifiedScorer.copy_patterns for tok in pat.findall(text)}
+
+    def translation_terms(self, text: str) -> Set[str]:
+        ttab = self.ttab
+        if not ttab:
+            return set()
+        toks = {tok for tok in ttab.src_prep(text) if tok in ttab.fwd}
+        freq = lambda tok: ttab.src_freq.get(ttab.src_tok2id.get(tok), 0)
+        rare = sorted(toks, key=freq)[:self.n_rare]
+        terms = set()
+        for tok in rare:
+            trans = sorted(ttab.fwd[tok].items(), key=lambda x: x[1], reverse=True)[:self.n_trans]
+            terms.update(tgt_tok for tgt_tok, _ in trans if tgt_tok)
+        return terms
+
+    def __call__(self, text: str) -> Set[str]:
+        terms = self.copy_terms(text) | self.translation_terms(text)
+        return {term.lower() for term in terms} if self.lowercase else terms
+
+    def hit_terms(self, text: str) -> Set[str]:
+        """Terms of a retrieved segment, to match it back to the source segments of a grouped request"""
+        toks = set(text.split()) | self.copy_terms(text)
+        return {tok.lower() for tok in toks} if self.lowercase else toks
+
+
+def quote(term: str) -> str:
+    return '"' + _special_chars.sub(r'\\\1', term) + '"'
+
+
+def _batches(segs: Iterable, size: int) -> Iterator[List]:
+    segs = iter(segs)
+    while True:
+        batch = list(islice(segs, size))
+        if not batch:
+            break
+        yield batch
+
+
+class Retriever:
+
+    def __init__(self, solr, builder: QueryBuilder, lang='eng', corpus=None, top_k=10, batch_size=20,
+                 rows_per_seg=30, workers=4):
+        """
+        :param solr: solr.Solr client, or any backend with the same query() method
+        :param builder: builds the query terms of a source segment
+        :param lang: language of the segments to retrieve
+        :param corpus: restrict to the segments tagged with this corpus (optional)
+        :param top_k: number of candidates per source segment
+        :param batch_size: number of source segments grouped into one request
+        :param rows_per_seg: number of hits requested per source segment of a group
+        :param workers: number of concurrent requests
+        """
+        self.solr = solr
+        self.builder = builder
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.rows_per_seg = rows_per_seg
+        self.workers = workers
+        self.filters = [f'lang:{quote(lang)}'] + ([f'corpus:{quote(corpus)}'] if corpus else [])
+
+    def _retrieve_batch(self, batch: List[Seg]) -> List[Tuple[Seg, List[Seg]]]:
+        queries = [self.builder(text) for _, text in batch]
+        all_terms = set().union(*queries)
+        if not all_terms:
+            return [(seg, []) for seg in batch]
+        query = 'text:(' + ' OR '.join(map(quote, sorted(all_terms))) + ')'
+        resp = self.solr.query(query, rows=self.rows_per_seg * len(batch), fl='id,text', fq=self.filters)
+        hits = [(doc['id'], doc['text']) for doc in resp['response']['docs']] if resp else []
+        hit_terms = [self.builder.hit_terms(text) for _, text in hits]
+        res = []
+        for seg, terms in zip(batch, queries):
+            scores = Counter({i: len(terms & hterms) for i, hterms in enumerate(hit_terms)})
+            cands = [hits[i] for i, n in scores.most_common(self.top_k) if n > 0]
+            res.append((seg, cands))
+        return res
+
+    def retrieve(self, segs: Iterable[Seg]) -> Iterator[Tuple[Seg, List[Seg]]]:
+        """
+        :param segs: source segments as (id, text)
+        :return: ((src_id, src_text), [(eng_id, eng_text)]) for each source segment, in the input order
+        """
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch in _batches(segs, self.batch_size):
+                while len(in_flight) >= 2 * self.workers:    # backpressure, as in solr.post_iterator
+                    yield from in_flight.popleft().result()
+                in_flight.append(pool.submit(self._retrieve_batch, batch))
+            while in_flight:
+                yield from in_flight.popleft().result()
+
+
+def rescore(cands: Iterable[Tuple[Seg, List[Seg]]], scorer, threshold=0.0, threads=1, chunk_size=1000) \
+        -> Iterator[Tuple[str, str, float]]:
+    """
+    Scores the candidates with the scorer
+    :return: (src_id, eng_id, score) of the candidates scoring at least the threshold
+    """
+    flat = ((src_id, eng_id, src_txt, eng_txt) for (src_id, src_txt), hits in cands for eng_id, eng_txt in hits)
+    pool = mp.Pool(threads, initializer=init_scorer, initargs=(scorer,)) if threads > 1 else None
+    init_scorer(scorer)
+    try:
+        chunks = _batches(flat, chunk_size)
+        scored = pool.imap(score_cands, chunks) if pool else map(score_cands, chunks)
+        for res in scored:
+            yield from (rec for rec in res if rec[2] >= threshold)
+    except BaseException:   # including the consumer closing this generator early
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()     # so that the workers run their finalizers, e.g. the score cache flush
+
+
+def read_segs(ltf_dir) -> Iterator[Seg]:
+    for doc in read_ltf_dir(ltf_dir):
+        for seg_id, text in doc.get_segs():
+            yield f'{doc.doc_id}.{seg_id}', text
+
+
+def main(found_dir, src_lang, solr_url, out, flags, threshold, top_k, batch_size, rows_per_seg, workers, threads,
+         corpus=None, n_rare=3, n_trans=3, **args):
+    from solr import connect
+    ttab = None
+    if args.get('ttab_file'):
+        from ttab import TTable
+        ttab = TTable.load_from(args['ttab_file'])
+    builder = QueryBuilder(ttab, n_rare=n_rare, n_trans=n_trans)
+    retriever = Retriever(connect(solr_url, pool_size=workers), builder, corpus=corpus, top_k=top_k,
+                          batch_size=batch_size, rows_per_seg=rows_per_seg, workers=workers)
+    scorer = get_scorer(flags, debug=debug_mode, threshold=threshold, **args)
+    cands = retriever.retrieve(read_segs(f'{found_dir}/{src_lang}/ltf'))
+    count = 0
+    for src_id, eng_id, score in rescore(cands, scorer, threshold=threshold, threads=threads):
+        out.write(f'{src_id}\t{eng_id}\t{score:.4f}\n')
+        count += 1
+    log.info(f"Wrote {count} scored candidates")
+
+
+if __name__ == '__main__':
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-fd', '--found-dir', type=str, required=True,
+                   help='Path to "found" dir that has eng and xyz lan')
+    p.add_argument('-l', '--lang', dest='src_lang', type=str, required=True, help='source language code')
+    p.add_argument('-s', '--solr-url', type=str, required=True,
+                   help='Solr URL (or local index path) having the english segments, see ltfreader.py --solr-url')
+    p.add_argument('-c', '--corpus', type=str, help='Retrieve only the segments tagged with this corpus')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
+                   help='Output file. Format: src_doc.seg_id<tab>eng_doc.seg_id<tab>score; see rematcher.py')
+    p.add_argument('-f', '--flags', type=str, default='charlen,toklen,copypatn,ascii,mcss',
+                   help='comma separated list of scorers to rescore the candidates. See realigner.py')
+    p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+    p.add_argument('-th', '--threshold', type=float, default=0.0,
+                   help='threshold score below which the sentence pairs must be ignored')
+    p.add_argument('-k', '--top-k', type=int, default=10, help='Number of candidates to rescore per source segment')
+    p.add_argument('-bs', '--batch-size', type=int, default=20,
+                   help='Number of source segments grouped into one Solr request')
+    p.add_argument('-rs', '--rows-per-seg', type=int, default=30,
+                   help='Number of hits requested per source segment of a group')
+    p.add_argument('-nr', '--n-rare', type=int, default=3, help='Number of the rarest source tokens to translate')
+    p.add_argument('-ntr', '--n-trans', type=int, default=3, help='Number of translations per rare token')
+    p.add_argument('-w', '--workers', type=int, default=4, help='Number of concurrent Solr requests')
+    p.add_argument('-nt', '--threads', type=int, default=2, help='Number of processes for rescoring')
+
+    p.add_argument('-se', '--src-emb', type=str, help='path to source language embedding (flag=mcss)')
+    p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (flag=mcss)')
+    p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size')
+    p.add_argument('-tf', '--ttab-file', type=str,
+                   help='Path to ttab file; used for translating the query terms, and for rescoring with flag=ttab')
+    p.add_argument('-sc', '--score-cache', type=str,
+                   help='Cache the scores of the sentence pairs in this file, and reuse them (see scorecache.py)')
+
+    args = vars(p.parse_args())
+    if args.pop('debug'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+        log.debug("Debug Mode ON")
+    main(**args)
+    log.info("Done.")
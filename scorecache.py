@@ -0,0 +1,226 @@
+"""
+Cache of the scores of (source, target) sentence pairs.
+
+Boilerplate, datelines and repeated headlines give the same sentence pairs again and again, within and across the
+LDC packs and the re-runs. `CachedScorer` wraps any scorer from `scorer.get_scorer` and scores a pair only once:
+an in-memory LRU is in front of a SQLite file keyed by (scorer fingerprint, hash(src), hash(tgt)).
+The fingerprint is made of the flags and of the model files, so the scores of a different setup are never mixed up.
+
+The file is shared by all the processes using it: a pickled CachedScorer (as sent to the pool workers) opens its
+own connection, and the new scores are written in batches. The file is bounded to max_rows; the least recently
+used rows are evicted when it grows beyond. Hit rates are logged when a process is done with the cache.
+"""
+import hashlib
+import logging as log
+import multiprocessing.util as mp_util
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+log.basicConfig(level=log.INFO)
+
+Key = Tuple[int, int]   # (hash(src), hash(tgt))
+_instances = {}     # (path, fingerprint) -> the state of the cache in this process
+
+
+def text_hash(text: str) -> int:
+    """64 bit hash of a text, stable across processes and runs (unlike hash())"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def scorer_fingerprint(flags, order=None, weights=None, agg_threshold=None, **args) -> int:
+    """
+    Fingerprint of a scorer setup: the flags, the cascade order of UnifiedScorer, the weights and threshold of
+    ScoreAggregator, and the size and mtime of the model files
+    """
+    parts = [flags if type(flags) is str else ','.join(flags)]
+    if order:
+        parts.append(f"order={','.join(order)}")
+    if weights:
+        parts.append(f'weights={weights}')
+    if agg_threshold is not None:
+        parts.append(f'agg_threshold={agg_threshold}')
+    for name in ('src_emb', 'eng_emb', 'ttab_file'):
+        path = args.get(name)
+        if path:
+            stat = os.stat(path)
+            parts.append(f'{name}={os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}')
+    if args.get('src_emb'):
+        parts.append(f"max_vocab={args.get('max_vocab')}")
+    return text_hash('\n'.join(parts))
+
+
+class CachedScorer:
+    """Scorer with a score cache; see the module doc"""
+
+    def __init__(self, scorer, path, fingerprint: int, capacity=100_000, max_rows=10_000_000, flush_size=2000):
+        """
+        :param scorer: the scorer to cache
+        :param path: path to the cache file; created if missing
+        :param fingerprint: fingerprint of the scorer setup, see scorer_fingerprint
+        :param capacity: number of scores kept in memory, per process
+        :param max_rows: maximum number of scores in the file
+        :param flush_size: number of new scores buffered before they are written to the file
+        """
+        self.scorer = scorer
+        self.path = path
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.max_rows = max_rows
+        self.flush_size = flush_size
+        self._reset()
+        if hasattr(scorer, 'score_pairs'):
+            self.score_pairs = self._score_pairs
+        if hasattr(scorer, 'embed'):
+            self.embed = scorer.embed
+
+    def _reset(self):
+        """State of this process; none of it is pickled"""
+        self._lru: OrderedDict = OrderedDict()
+        self._new: Dict[Key, float] = {}
+        self._touched: List[Key] = []
+        self._con: Optional[sqlite3.Connection] = None
+        # the connection is used by the scoring threads (e.g. of scoreserver.py) and closed by the main one at exit
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def __getstate__(self):
+        return dict(scorer=self.scorer, path=self.path, fingerprint=self.fingerprint, capacity=self.capacity,
+                    max_rows=self.max_rows, flush_size=self.flush_size)
+
+    def __setstate__(self, state):
+        """The copies unpickled in a process (e.g. one per task of a pool) share the LRU, buffers and stats"""
+        shared = _instances.get((state['path'], state['fingerprint']))
+        if shared is not None and shared['_pid'] == os.getpid():
+            self.__dict__ = shared
+        else:
+            self.__init__(**state)
+            _instances[(self.path, self.fingerprint)] = self.__dict__
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._con is None or self._pid != os.getpid():
+            if self._pid != os.getpid():     # forked; the parent's buffers are not ours to write
+                self._reset()
+            con = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            with con:
+                con.execute('CREATE TABLE IF NOT EXISTS scores (fp INTEGER, src INTEGER, tgt INTEGER, score REAL,'
+                            ' used REAL, PRIMARY KEY (fp, src, tgt))')
+                con.execute('CREATE INDEX IF NOT EXISTS scores_used ON scores (used)')
+            self._con = con
+            mp_util.Finalize(self, CachedScorer.close, args=(self,), exitpriority=10)
+        return self._con
+
+    def _remember(self, key: Key, score: float):
+        lru = self._lru
+        lru[key] = score
+        if len(lru) > self.capacity:
+            lru.popitem(last=False)
+
+    def _lookup(self, keys: Sequence[Key]) -> Dict[Key, float]:
+        """Scores of the keys found in memory or in the file"""
+        with self._lock:
+            return self._lookup_locked(keys)
+
+    def _lookup_locked(self, keys: Sequence[Key]) -> Dict[Key, float]:
+        con = self._connect()
+        found, todo = {}, []
+        for key in keys:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                found[key] = self._lru[key]
+                self.hits += 1
+            elif key in self._new:
+                found[key] = self._new[key]
+                self.hits += 1
+            else:
+                todo.append(key)
+        for start in range(0, len(todo), 400):      # keeps the number of sql variables bounded
+            batch = todo[start: start + 400]
+            cond = ' OR '.join(['(src=? AND tgt=?)'] * len(batch))
+            params = [self.fingerprint] + [h for key in batch for h in key]
+            for src, tgt, score in con.execute(f'SELECT src, tgt, score FROM scores WHERE fp=? AND ({cond})', params):
+                key = src, tgt
+                found[key] = score
+                self._remember(key, score)
+                self._touched.append(key)
+                self.disk_hits += 1
+        self.misses += sum(1 for key in todo if key not in found)
+        return found
+
+    def _add(self, key: Key, score: float):
+        with self._lock:
+            self._new[key] = score
+            self._remember(key, score)
+            if len(self._new) + len(self._touched) >= self.flush_size:
+                self.flush()
+
+    def score(self, src: str, tgt: str) -> float:
+        key = text_hash(src), text_hash(tgt)
+        found = self._lookup([key])
+        if key in found:
+            return found[key]
+        score = self.scorer.score(src, tgt)
+        self._add(key, score)
+        return score
+
+    def _score_pairs(self, src_sents: Sequence[str], tgt_sents: Sequence[str]):
+        """Scores the pairs which are not in the cache with the score_pairs of the wrapped scorer"""
+        keys = [(text_hash(src), text_hash(tgt)) for src, tgt in zip(src_sents, tgt_sents)]
+        found = self._lookup(keys)
+        todo = [i for i, key in enumerate(keys) if key not in found]
+        if todo:
+            scores = self.scorer.score_pairs([src_sents[i] for i in todo], [tgt_sents[i] for i in todo])
+            for i, score in zip(todo, scores):
+                found[keys[i]] = float(score)
+                self._add(keys[i], float(score))
+        return [found[key] for key in keys]
+
+    def flush(self):
+        """Writes the new scores, refreshes the recently used ones, and evicts when the file is full"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not (self._new or self._touched) or self._con is None:
+            return
+        now = time.time()
+        con = self._con
+        with con:
+            con.executemany('INSERT OR REPLACE INTO scores (fp, src, tgt, score, used) VALUES (?, ?, ?, ?, ?)',
+                            [(self.fingerprint, src, tgt, score, now) for (src, tgt), score in self._new.items()])
+            con.executemany('UPDATE scores SET used=? WHERE fp=? AND src=? AND tgt=?',
+                            [(now, self.fingerprint, src, tgt) for src, tgt in self._touched])
+            count = con.execute('SELECT count(*) FROM scores').fetchone()[0]
+            if count > self.max_rows:
+                evict = count - int(0.9 * self.max_rows)    # makes room for many flushes at once
+                con.execute('DELETE FROM scores WHERE used <= (SELECT used FROM scores ORDER BY used LIMIT 1 OFFSET ?)',
+                            (evict - 1,))
+                log.info(f"Score cache {self.path}: evicted {evict} least recently used of {count} scores")
+        self._new.clear()
+        self._touched.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'lookups': lookups, 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            if self._con is None or self._pid != os.getpid():
+                return
+            try:
+                self._flush()
+            except sqlite3.Error as e:
+                log.error(f"Could not write the scores to {self.path}: {e}")
+            self._con.close()
+            self._con = None
+        st = self.stats()
+        if st['lookups']:
+            log.info(f"Score cache {self.path}: {st['lookups']} lookups, hit rate {100 * st['hit_rate']:.1f}%"
+                     f" (memory: {st['hits']}, disk: {st['disk_hits']}, misses: {st['misses']})")
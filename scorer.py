@@ -2,9 +2,14 @@
 """
 A scorer for mining parallel/comparable sentences from comparable documents
 """
+import itertools
+import json
 import logging as log
+import os
 import re
-from ttab import TTable, Preprocessor  # the pickler complains about not having this
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
 
 log.basicConfig(level=log.INFO)
 
@@ -21,7 +26,16 @@ class UnifiedScorer:
 
     copy_patterns = [re.compile(p) for p in [r'(\d+)', r'(https?://[^ ]+)']]
 
-    def __init__(self, final_scorer, flags='charlen,toklen,copypatn,ascii', debug=False):
+    def __init__(self, final_scorer, flags='charlen,toklen,copypatn,ascii', debug=False, order=None, adapt=0):
+        """
+        :param final_scorer: scorer of the pairs which are neither accepted nor rejected by the heuristics
+        :param flags: heuristics of the cascade
+        :param debug: log the scores
+        :param order: order of the cascade (comma separated flags, or a list); default is the order of flags.
+          The order matters only for the pairs with conflicting evidence, where the first decisive heuristic wins
+        :param adapt: number of warm-up pairs to measure the cost and the decisive rate of each heuristic on, see
+          warm_up; the cascade is then reordered to the least expected cost. 0 keeps the order as it is
+        """
         flags = flags.split(',') if type(flags) is str else flags
         mapping = {
             'copypatn': self.copy_score,
@@ -30,11 +44,19 @@ class UnifiedScorer:
             'ascii': self.ascii_ratio_score,
         }
         flags = flags.split(',') if type(flags) is str else flags
+        if order:
+            order = order.split(',') if type(order) is str else order
+            assert sorted(order) == sorted(flags), f'Cascade order {order} must have the same flags as {flags}'
+            flags = order
+        self.flags = list(flags)
         self.scorers = [mapping[flag] for flag in flags]
         if not final_scorer:
             log.warning('Final Scorer is None, this setting is not recommended')
         self.final_scorer = final_scorer.score if final_scorer else None
         self.debug = debug
+        self.adapt = adapt
+        self.seen = 0
+        self.stats = {flag: [0, 0.0, 0] for flag in flags}    # flag -> [calls, seconds, decisive calls]
 
     def copy_score(self, src: str, tgt: str) -> float:
         score = 0.0
@@ -75,6 +97,57 @@ class UnifiedScorer:
         else:
             return self.must_reject
 
+    def _measure(self, src: str, tgt: str):
+        """Runs all the heuristics on a pair, to measure them"""
+        for flag, scorer in zip(self.flags, self.scorers):
+            start = time.perf_counter()
+            score = scorer(src, tgt)
+            stat = self.stats[flag]
+            stat[0] += 1
+            stat[1] += time.perf_counter() - start
+            stat[2] += score >= self.must_accept or score <= self.must_reject
+        self.seen += 1
+
+    def warm_up(self, pairs: Iterable[Tuple[str, str]]) -> int:
+        """
+        Measures the heuristics on the first `adapt` of the (src, tgt) pairs, and reorders the cascade.
+        The order decides the pairs having conflicting evidence, so this is done once, before any pair is scored
+        and before the scorer is sent to the workers; all the pairs are then scored in the same order.
+        :return: number of pairs measured
+        """
+        for src, tgt in itertools.islice(pairs, max(0, self.adapt - self.seen)):
+            self._measure(src, tgt)
+        if self.seen:
+            self.reorder()
+        return self.seen
+
+    def cascade_stats(self) -> Dict[str, Dict[str, float]]:
+        """flag -> mean cost (in microseconds) and decisive rate, as measured in the warm-up"""
+        return {flag: {'calls': calls, 'cost_us': 1e6 * secs / calls if calls else 0.0,
+                       'decisive_rate': decisive / calls if calls else 0.0}
+                for flag, (calls, secs, decisive) in self.stats.items()}
+
+    def reorder(self):
+        """
+        Orders the heuristics by cost / decisive rate, which minimizes the expected cost per pair when the
+        heuristics are independent; the ones which never decided go last, the cheapest first
+        """
+        stats = self.cascade_stats()
+        key = lambda flag: (stats[flag]['cost_us'] / stats[flag]['decisive_rate']
+                            if stats[flag]['decisive_rate'] else float('inf'), stats[flag]['cost_us'])
+        order = sorted(self.flags, key=key)
+        scorers = dict(zip(self.flags, self.scorers))
+        self.flags, self.scorers = order, [scorers[flag] for flag in order]
+        log.info(f"Cascade order after {self.seen} pairs: " + ', '.join(
+            f"{flag} ({stats[flag]['cost_us']:.1f}us, {100 * stats[flag]['decisive_rate']:.1f}% decisive)"
+            for flag in order))
+
+    def export_cascade(self, path):
+        """Saves the cascade order and the stats; pin the order in other runs with load_cascade(path)"""
+        with open(path, 'w') as f:
+            json.dump({'order': self.flags, 'pairs': self.seen, 'stats': self.cascade_stats()}, f, indent=2)
+        log.info(f"Cascade order {','.join(self.flags)} is saved to {path}")
+
     def score(self, src: str, tgt: str) -> float:
         # negative means No, positive means yes
         tot_score = 0.0
@@ -96,39 +169,190 @@ class UnifiedScorer:
 
 
 class ScoreAggregator:
-    """Aggregates scores from multiple scoring functions"""
+    """
+    Aggregates scores from multiple scoring functions, as their weighted mean.
+    The scorers are run cheapest first (by their cost measured in a warm-up), and given a threshold, the rest are
+    skipped as soon as the mean can no longer reach it, even if the remaining scorers give their maximum score.
+    All the pairs below the threshold get the lowest possible score, whether they were skipped or not, so that
+    the scores do not depend on the order, which each process measures on its own.
+    Each scorer may declare the range of its scores as `score_range` (default: -1 to 1).
+    """
 
-    def __init__(self, scorers):
-        assert len(scorer) > 0
+    def __init__(self, scorers, weights=None, threshold=None, warmup=100, workers=None):
+        """
+        :param scorers: the scorers to aggregate
+        :param weights: weight of each scorer; default is equal weights
+        :param threshold: the aggregate scores below this are not needed exactly; such a pair gets the lowest
+          possible score (see `floor`). None computes all the scores of every pair
+        :param warmup: number of pairs to measure the cost of the scorers on, before ordering them
+        :param workers: number of threads to run the scorers concurrently in score_pairs; default is one per scorer
+        """
+        assert len(scorers) > 0
+        weights = weights or [1.0] * len(scorers)
+        assert len(weights) == len(scorers), f'{len(weights)} weights for {len(scorers)} scorers'
+        assert all(w > 0 for w in weights)
         self.scorers = scorers
+        self.weights = weights
+        self.total_weight = sum(weights)
+        ranges = [getattr(scorer, 'score_range', (-1.0, 1.0)) for scorer in scorers]
+        self.highs = [high for _, high in ranges]
+        self.floor = sum(w * low for w, (low, _) in zip(weights, ranges)) / self.total_weight
+        self.threshold = threshold
+        self.warmup = warmup
+        self.workers = workers or len(scorers)
+        self.order = list(range(len(scorers)))
+        self.costs = [0.0] * len(scorers)
+        self.seen = 0
+        self.skipped = 0
+
+    def _measured_score(self, src, tgt):
+        total = 0.0
+        for i, (scorer, weight) in enumerate(zip(self.scorers, self.weights)):
+            start = time.perf_counter()
+            total += weight * scorer.score(src, tgt)
+            self.costs[i] += time.perf_counter() - start
+        self.seen += 1
+        if self.seen == self.warmup:
+            self.order = sorted(self.order, key=lambda i: self.costs[i])
+            log.info('Aggregator order: ' + ', '.join(f'{type(self.scorers[i]).__name__}'
+                                                      f' ({1e6 * self.costs[i] / self.seen:.1f}us)' for i in self.order))
+        return self._final(total / self.total_weight)
+
+    def _final(self, score):
+        return self.floor if self.threshold is not None and score < self.threshold else score
 
     def score(self, src, tgt):
-        scores = [s.score(src, tgt) for s in self.scorers]
-        return sum(scores) / len(scores)
+        if self.seen < self.warmup:
+            return self._measured_score(src, tgt)
+        total = 0.0
+        bound = sum(w * high for w, high in zip(self.weights, self.highs))     # weighted sum at best
+        for i in self.order:
+            weight = self.weights[i]
+            total += weight * self.scorers[i].score(src, tgt)
+            bound -= weight * self.highs[i]
+            if self.threshold is not None and (total + bound) / self.total_weight < self.threshold:
+                self.skipped += 1
+                return self.floor
+        return self._final(total / self.total_weight)
+
+    @staticmethod
+    def _scorer_pairs(scorer, src_sents, tgt_sents):
+        import numpy as np
+        if hasattr(scorer, 'score_pairs'):
+            return np.asarray(scorer.score_pairs(src_sents, tgt_sents), dtype=np.float64)
+        return np.array([scorer.score(src, tgt) for src, tgt in zip(src_sents, tgt_sents)], dtype=np.float64)
+
+    def score_pairs(self, src_sents, tgt_sents):
+        """
+        Scores many pairs at once; the scorers run concurrently in threads, each one on all the pairs
+        :return: array of the aggregate scores, without skipping any scorer; the ones below the threshold are
+          the floor, as in score
+        """
+        import numpy as np
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._scorer_pairs, scorer, src_sents, tgt_sents) for scorer in self.scorers]
+            total = sum(weight * future.result() for weight, future in zip(self.weights, futures))
+        scores = total / self.total_weight
+        if self.threshold is not None:
+            scores = np.where(scores < self.threshold, self.floor, scores)
+        return scores
+
+
+def parse_weights(weights: str, names: List[str]) -> List[float]:
+    """Weights of the scorers from name:weight pairs, e.g. "mcss:2,ttab:1"; the names not given weigh 1"""
+    given = dict(item.split(':') for item in weights.split(','))
+    assert set(given) <= set(names), f'Weights {weights} are for the scorers other than {names}'
+    return [float(given.get(name, 1.0)) for name in names]
+
+
+def load_cascade(order) -> List[str]:
+    """Cascade order from comma separated flags, or from a file saved by UnifiedScorer.export_cascade"""
+    if os.path.isfile(order):
+        with open(order) as f:
+            return json.load(f)['order']
+    return order.split(',')
+
+
+def _agg_threshold(flags, args):
+    # the aggregate scores below the threshold are the floor, not the exact scores
+    return args.get('threshold') if {'mcss', 'ttab'} <= set(flags.split(',')) else None
+
+
+def get_fingerprint(flags, order=None, **args) -> int:
+    """
+    Fingerprint of the scorer made by get_scorer(flags, **args); see scorecache.scorer_fingerprint
+    :param order: the cascade order it ended up with after a warm-up; default is the cascade_order arg
+    """
+    from scorecache import scorer_fingerprint
+    cascade_order = args.pop('cascade_order', None)
+    # the order decides the pairs having conflicting evidence, so it is a part of the setup; with adapt_cascade,
+    # it is known only after the warm-up, see warm_up_cascade
+    args.pop('adapt_cascade', None)
+    order = order or (load_cascade(cascade_order) if cascade_order else None)
+    return scorer_fingerprint(flags, order=order, weights=args.pop('scorer_weights', None),
+                              agg_threshold=_agg_threshold(flags, args), **args)
 
 
 def get_scorer(flags, debug=False, **args):
-    scorers = []
+    server = args.pop('server', None)
+    if server:      # the models are loaded by the server, see scoreserver.py
+        ignored = [f"--{name.replace('_', '-')}" for name in
+                   ('score_cache', 'cascade_order', 'adapt_cascade', 'scorer_weights') if args.get(name)]
+        assert not ignored, f'{", ".join(ignored)} can not be used with --server; give them to scoreserver.py'
+        from scoreserver import ScoreClient
+        return ScoreClient(server, flags=flags)
+    cache_path = args.pop('score_cache', None)
+    if cache_path:
+        from scorecache import CachedScorer
+        fingerprint = get_fingerprint(flags, **args)
+    order = args.pop('cascade_order', None)
+    order = load_cascade(order) if order else None
+    adapt = args.pop('adapt_cascade', 0) or 0
+    weights = args.pop('scorer_weights', None)
+    agg_threshold = _agg_threshold(flags, args)
+    scorers, names = [], []
     flags = flags.split(',')
     if 'mcss' in flags:
         flags.remove('mcss')
-        src_emb, eng_emb, max_vocab = args.pop('src_emb'), args.pop('eng_emb'), args.pop('max_vocab')
-        assert src_emb and eng_emb, '--src-emb and --eng-emb args are required if "mcss" is enabled'
-        from mcss import MCSS
-        scorers.append(MCSS(src_vec_path=src_emb, tgt_vec_path=eng_emb, nmax=max_vocab))
+        mcss = args.pop('mcss', None)    # an already loaded MCSS can be shared
+        if not mcss:
+            src_emb, eng_emb, max_vocab = args.pop('src_emb'), args.pop('eng_emb'), args.pop('max_vocab')
+            assert src_emb and eng_emb, '--src-emb and --eng-emb args are required if "mcss" is enabled'
+            from mcss import MCSS
+            mcss = MCSS(src_vec_path=src_emb, tgt_vec_path=eng_emb, nmax=max_vocab)
+        scorers.append(mcss)
+        names.append('mcss')
     if 'ttab' in flags:
         flags.remove('ttab')
         ttab_file = args.pop('ttab_file')
         assert ttab_file, '--ttab is needed for this combination of args'
         from transcorer import TranScorer
         scorers.append(TranScorer.new(ttab_file))
+        names.append('ttab')
 
     final_scorer = None
     if len(scorers) == 1:
         final_scorer = scorers[0]
     elif len(scorers) > 1:
-        final_scorer = ScoreAggregator(scorers)
-    return UnifiedScorer(final_scorer, flags=flags, debug=debug) if flags else final_scorer
+        weights = parse_weights(weights, names) if weights else None
+        final_scorer = ScoreAggregator(scorers, weights=weights, threshold=agg_threshold)
+    scorer = UnifiedScorer(final_scorer, flags=flags, debug=debug, order=order, adapt=adapt) if flags else final_scorer
+    if cache_path:
+        scorer = CachedScorer(scorer, cache_path, fingerprint)
+    return scorer
+
+
+def warm_up_cascade(scorer, pairs: Iterable[Tuple[str, str]], flags, **args):
+    """
+    Reorders the cascade of a scorer made with adapt_cascade (see UnifiedScorer.warm_up); others are left as is.
+    The score cache, if any, is then keyed on the order the cascade ended up with
+    :param flags, args: the args of get_scorer
+    """
+    unified = getattr(scorer, 'scorer', scorer)     # under the score cache, if any
+    if isinstance(unified, UnifiedScorer) and unified.adapt:
+        unified.warm_up(pairs)
+        if unified is not scorer:
+            scorer.fingerprint = get_fingerprint(flags, order=unified.flags, **args)
 
 
 def predict(scorer, inp, out, **args):
@@ -141,6 +365,7 @@ def predict(scorer, inp, out, **args):
 if __name__ == '__main__':
     import argparse
     import sys
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     p.add_argument('-i', '--inp', type=argparse.FileType('r'), default=sys.stdin,
                    help='Source<tab>english sentence per line')
@@ -153,18 +378,44 @@ if __name__ == '__main__':
     p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (flag=mcss)')
     p.add_argument('-m', '--max-vocab', type=int, help='Max vocabulary size (flag=mcss)', default=int(1e6))
     p.add_argument('-tf', '--ttab-file', type=str, help='ttab.TTab pickle file (flag=ttab)')
+    p.add_argument('-sw', '--scorer-weights', type=str,
+                   help='Weights of the scorers to combine, e.g. "mcss:2,ttab:1" (flags=mcss,ttab). Default: equal')
+    p.add_argument('-sc', '--score-cache', type=str,
+                   help='Cache the scores of the sentence pairs in this file, and reuse them (see scorecache.py)')
+    p.add_argument('-srv', '--server', type=str,
+                   help='Score with a running scoreserver.py at this Unix socket path or host:port, instead of'
+                        ' loading the models here')
+    p.add_argument('-co', '--cascade-order', type=str,
+                   help='Order of the heuristics: comma separated flags, or a file saved with --export-cascade')
+    p.add_argument('-ac', '--adapt-cascade', type=int, default=0,
+                   help='Measure the heuristics on these many pairs, then reorder them to the least expected cost')
+    p.add_argument('-ec', '--export-cascade', type=str,
+                   help='Save the cascade order and the stats of the heuristics to this file, to pin with'
+                        ' --cascade-order in other runs. Stats are measured with --adapt-cascade')
     p.add_argument('-n', '--neg-samples', dest='neg_sample_count', type=int, default=40,
                    help='Number of random negative samples to test against')
     p.add_argument('-s', '--seed', type=int, default=None, help='seed for reproducing (random shuffle for negatives)')
+    p.add_argument('-nt', '--threads', type=int, default=1, help='Number of processes for scoring (in --test mode)')
+    p.add_argument('-r', '--retrieval', action='store_true',
+                   help='Also report P@1 and MRR of the positives (in --test mode)')
     p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
     p.add_argument('-t', '--test', action='store_true',
                    help="Turn on the test mode. In test mode, assume the input is parallel text "
                         "(i.e. positive alignments) and randomly shuffles the input to obtain negative alignments")
     args = vars(p.parse_args())
 
+    export_path = args.pop('export_cascade')
     scorer = get_scorer(**args)
+    if args['adapt_cascade']:
+        head = list(itertools.islice(args['inp'], args['adapt_cascade']))
+        warm_up_cascade(scorer, (line.strip().split('\t') for line in head), **args)
+        args['inp'] = itertools.chain(head, args['inp'])
     if args.pop('test'):
         from utils import scorer_eval
         scorer_eval(scorer, **args)
     else:
         predict(scorer, **args)
+    if export_path:
+        unified = getattr(scorer, 'scorer', scorer)    # under the score cache, if any
+        assert isinstance(unified, UnifiedScorer), '--export-cascade needs heuristics in --flags'
+        unified.export_cascade(export_path)
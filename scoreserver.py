@@ -0,0 +1,275 @@
+"""
+Long lived scoring server, so that the short jobs do not pay for loading the t-table and the embeddings.
+
+The server loads `scorer.get_scorer(flags, ...)` once and listens on a Unix socket (any path) or on a TCP port of
+localhost (host:port). The protocol is one JSON object per line, in both directions:
+    {"op": "pairs", "pairs": [[src, tgt], ...]}   -> {"scores": [score, ...]}
+    {"op": "matrix", "src": [..], "tgt": [..]}    -> {"scores": [[score of src[i] x tgt[j], ...], ...]}
+    {"op": "info"}                                -> {"flags": .., "pid": ..}
+and {"error": message} on failure. A connection may send any number of requests.
+The requests of all the connections go through a single queue; whatever is queued within max_wait milliseconds
+(up to max_batch pairs) is scored as one micro-batch, as utils.score_pairs does.
+
+`ScoreClient` is a scorer backed by a server; the CLIs get one from get_scorer with --server.
+"""
+import argparse
+import json
+import logging as log
+import os
+import queue
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+log.basicConfig(level=log.INFO)
+debug_mode = False
+
+tcp_pat = re.compile(r'^([\w.-]*):(\d+)$')
+
+
+def parse_address(address: str):
+    """:return: (socket family, address) of host:port or of a Unix socket path"""
+    match = tcp_pat.match(address)
+    if match:
+        return socket.AF_INET, (match.group(1) or 'localhost', int(match.group(2)))
+    return socket.AF_UNIX, address
+
+
+class Batcher:
+    """Groups the pairs of the concurrent requests into micro-batches, scored by a single thread"""
+
+    def __init__(self, scorer, max_batch=10000, max_wait=5.0):
+        """
+        :param scorer: the scorer
+        :param max_batch: maximum number of pairs per batch; a larger request is a batch on its own
+        :param max_wait: milliseconds to wait for more requests after the first one of a batch
+        """
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.max_wait = max_wait / 1000
+        self.queue = queue.Queue()
+        self.batches, self.pairs = 0, 0
+        self._thread = threading.Thread(target=self._run, name='batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, pairs: List[Tuple[str, str]]) -> Future:
+        future = Future()
+        self.queue.put((pairs, future))
+        return future
+
+    def _run(self):
+        from utils import score_pairs
+        while True:
+            jobs = [self.queue.get()]
+            size = len(jobs[0][0])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    job = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                size += len(job[0])
+            try:
+                scores = score_pairs(self.scorer, [pair for pairs, _ in jobs for pair in pairs])
+            except Exception as e:
+                log.exception('Scoring failed')
+                for _, future in jobs:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.pairs += size
+            pos = 0
+            for pairs, future in jobs:
+                future.set_result(scores[pos: pos + len(pairs)])
+                pos += len(pairs)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                resp = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                resp = {'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(resp, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ScoreServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scorer, flags, max_batch=10000, max_wait=5.0):
+        self.address_family, address = parse_address(address)
+        if self.address_family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)      # left over from a server which was killed
+        self.allow_reuse_address = self.address_family != socket.AF_UNIX
+        super().__init__(address, RequestHandler)
+        self.flags = flags
+        self.batcher = Batcher(scorer, max_batch=max_batch, max_wait=max_wait)
+
+    def dispatch(self, req: Dict) -> Dict:
+        op = req.get('op')
+        if op == 'pairs':
+            return {'scores': self.batcher.submit([tuple(pair) for pair in req['pairs']]).result()}
+        if op == 'matrix':
+            srcs, tgts = req['src'], req['tgt']
+            scores = self.batcher.submit([(src, tgt) for src in srcs for tgt in tgts]).result()
+            return {'scores': [scores[i * len(tgts): (i + 1) * len(tgts)] for i in range(len(srcs))]}
+        if op == 'info':
+            return {'flags': self.flags, 'pid': os.getpid(), 'batches': self.batcher.batches,
+                    'pairs': self.batcher.pairs}
+        raise ValueError(f'Unknown op {op}')
+
+    def server_close(self):
+        super().server_close()
+        if self.address_family == socket.AF_UNIX and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class ScoreClient:
+    """Scorer which asks a ScoreServer; it can be pickled for the pool workers, each one connects on its own"""
+
+    def __init__(self, address, flags=None, batch_size=10000, timeout=600):
+        """
+        :param address: Unix socket path or host:port of the server
+        :param flags: the flags the caller expects the server to have; a mismatch is logged
+        :param batch_size: maximum number of pairs per request
+        :param timeout: seconds to wait for a response
+        """
+        self.address = address
+        self.flags = flags
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._sock, self._file, self._pid = None, None, None
+
+    def __getstate__(self):
+        return dict(address=self.address, flags=self.flags, batch_size=self.batch_size, timeout=self.timeout)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(address)
+        self._sock, self._file, self._pid = sock, sock.makefile('rwb'), os.getpid()
+        if self.flags:
+            info = self._call({'op': 'info'})
+            if info['flags'] != self.flags:
+                log.warning(f"Server {self.address} scores with flags={info['flags']}, not {self.flags}")
+
+    def _call(self, req: Dict) -> Dict:
+        if self._file is None or self._pid != os.getpid():
+            self._connect()
+        try:
+            self._file.write(json.dumps(req, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError(f'Server {self.address} closed the connection')
+        resp = json.loads(line)
+        if 'error' in resp:
+            raise RuntimeError(f"Server {self.address}: {resp['error']}")
+        return resp
+
+    def info(self) -> Dict:
+        return self._call({'op': 'info'})
+
+    def score(self, src: str, tgt: str) -> float:
+        return self._call({'op': 'pairs', 'pairs': [[src, tgt]]})['scores'][0]
+
+    def score_pairs(self, src_sents: Sequence[str], tgt_sents: Sequence[str]) -> List[float]:
+        pairs = [[src, tgt] for src, tgt in zip(src_sents, tgt_sents)]
+        scores = []
+        for start in range(0, len(pairs), self.batch_size):
+            scores.extend(self._call({'op': 'pairs', 'pairs': pairs[start: start + self.batch_size]})['scores'])
+        return scores
+
+    def score_matrix(self, src_sents: Sequence[str], tgt_sents: Sequence[str]) -> List[List[float]]:
+        """Scores of all the (source, target) pairs of two documents, in one request"""
+        return self._call({'op': 'matrix', 'src': list(src_sents), 'tgt': list(tgt_sents)})['scores']
+
+    def score_all(self, records: Iterable, parse=True):
+        """Same as TranScorer.score_all, in requests of batch_size pairs"""
+        records = (r.split('\t') for r in records) if parse else records
+        batch = []
+        for rec in records:
+            batch.append(rec)
+            if len(batch) >= self.batch_size:
+                yield from self._score_batch(batch)
+                batch = []
+        if batch:
+            yield from self._score_batch(batch)
+
+    def _score_batch(self, batch):
+        scores = self.score_pairs([src for src, _ in batch], [tgt for _, tgt in batch])
+        return ((score, src, tgt) for score, (src, tgt) in zip(scores, batch))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+
+def serve(address, flags, max_batch=10000, max_wait=5.0, **args):
+    from scorer import get_scorer
+    scorer = get_scorer(flags, debug=debug_mode, **args)
+    server = ScoreServer(address, scorer, flags, max_batch=max_batch, max_wait=max_wait)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    log.info(f"Serving {flags} at {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        log.info(f"Scored {server.batcher.pairs} pairs in {server.batcher.batches} batches")
+
+
+if __name__ == '__main__':
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-a', '--address', type=str, required=True,
+                   help='Unix socket path to listen on, or host:port for TCP (e.g. localhost:8984)')
+    p.add_argument('-f', '--flags', type=str, default='charlen,toklen,copypatn,ascii,ttab',
+                   help='comma separated list of scorers to use. See realigner.py')
+    p.add_argument('-mb', '--max-batch', type=int, default=10000, help='Maximum number of pairs per micro-batch')
+    p.add_argument('-mw', '--max-wait', type=float, default=5.0,
+                   help='Milliseconds to wait for more requests to fill a micro-batch')
+    p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+
+    p.add_argument('-se', '--src-emb', type=str, help='path to source language embedding (flag=mcss)')
+    p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (flag=mcss)')
+    p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size (flag=mcss)')
+    p.add_argument('-tf', '--ttab-file', type=str, help='Path to ttab file (flag=ttab)')
+    p.add_argument('-sc', '--score-cache', type=str,
+                   help='Cache the scores of the sentence pairs in this file, and reuse them (see scorecache.py)')
+    p.add_argument('-sw', '--scorer-weights', type=str,
+                   help='Weights of the scorers to combine, e.g. "mcss:2,ttab:1" (flags=mcss,ttab). Default: equal')
+    p.add_argument('-co', '--cascade-order', type=str,
+                   help='Order of the heuristics: comma separated flags, or a file saved by scorer.py --export-cascade')
+
+    args = vars(p.parse_args())
+    if args.pop('debug'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+        log.debug("Debug Mode ON")
+    serve(**args)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Guards the start-up cost of the modules: each one is imported in a fresh interpreter with `python -X importtime`,
+and the check fails (exit code 1) if a module loads a heavy optional dependency at import time, or takes longer
+than the budget. The optional dependencies must be imported inside the code paths that use them.
+
+    python scripts/import_budget.py            # all the modules, default budget
+    python scripts/import_budget.py -b 150 scorer realigner
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+heavy_deps = ('sklearn', 'scipy', 'lxml', 'requests', 'morfessor')
+# module -> heavy dependencies it may load at import time, because it can not do anything without them
+modules = {
+    'alnreader': (), 'alnstore': (), 'docmatcher': (), 'localindex': (), 'ltfcache': (), 'ltfreader': (),
+    'mcss': (), 'miner': (), 'realigner': (), 'rematcher': (), 'repacker': ('lxml',), 'retriever': (),
+    'scorecache': (), 'scorer': (), 'scoreserver': (), 'solr': (), 'sweeper': (), 'transcorer': (), 'ttab': (),
+    'utils': (), 'vfs': (),
+}
+line_pat = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def import_profile(module: str) -> Tuple[float, List[str]]:
+    """:return: (milliseconds to import the module, names of all the modules loaded by it)"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=repo_dir,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{proc.stderr[-2000:]}')
+    total, loaded = 0, []
+    for line in proc.stderr.splitlines():
+        match = line_pat.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        if name == module and len(indent) == 1:
+            total = int(cumulative)
+        else:
+            loaded.append(name)
+    return total / 1000, loaded
+
+
+def check(names: List[str], budget: float, repeat=3) -> Dict[str, List[str]]:
+    """:return: module -> problems; a module is timed `repeat` times and the best time is taken"""
+    problems = {}
+    for name in names:
+        times, loaded = [], []
+        for _ in range(repeat):
+            millis, loaded = import_profile(name)
+            times.append(millis)
+        best = min(times)
+        heavy = sorted({mod.split('.')[0] for mod in loaded if mod.split('.')[0] in heavy_deps}
+                       - set(modules.get(name, ())))
+        issues = [f'imports {dep}' for dep in heavy]
+        if best > budget:
+            issues.append(f'takes {best:.1f}ms > {budget:.1f}ms')
+        print(f'{name:12s} {best:8.1f}ms  {"; ".join(issues) or "ok"}')
+        if issues:
+            problems[name] = issues
+    return problems
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('modules', nargs='*', help='Modules to check; default: all of them')
+    p.add_argument('-b', '--budget', type=float, default=300,
+                   help='Milliseconds allowed per module, including numpy where it is needed')
+    p.add_argument('-r', '--repeat', type=int, default=3, help='Number of times to import each module')
+    args = p.parse_args()
+    problems = check(args.modules or sorted(modules), budget=args.budget, repeat=args.repeat)
+    if problems:
+        print(f'{len(problems)} modules are over the start-up budget', file=sys.stderr)
+        sys.exit(1)
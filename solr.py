@@ -1,7 +1,9 @@
+import itertools
 import json
-import requests
 import time
 import logging as log
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 log.basicConfig(level=log.INFO)
 debug_mode = log.getLogger().isEnabledFor(level=log.DEBUG)
@@ -15,14 +17,29 @@ class Solr(object):
     Solr client  for querying, posting and committing
     """
 
-    def __init__(self, solr_url):
+    def __init__(self, solr_url, pool_size=8, retries=5, backoff=0.5, timeout=120):
+        """
+        :param solr_url: URL of the Solr core
+        :param pool_size: number of connections to keep alive
+        :param retries: number of retries of a failed post
+        :param backoff: seconds to wait before the first retry; doubled on every retry
+        :param timeout: seconds to wait for a response
+        """
         self.update_url = solr_url + '/update/json'
         self.query_url = solr_url + '/select'
         self.headers = {"content-type": "application/json"}
         self.posted_items = 0
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        import requests     # here, so that the users of the local index do not need it
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def post_items(self, items, commit=False, soft_commit=False):
-        """ post list of items to Solr; """
+        """ post list of items to Solr; failed posts are retried with exponential backoff """
         url = self.update_url
         # Check either to do soft commit or hard commit
         if commit:
@@ -30,16 +47,27 @@ class Solr(object):
         elif soft_commit:
             url = url + '?softCommit=true'
 
-        resp = requests.post(url,
-            data=json.dumps(items).encode('utf-8', 'replace'),
-            headers=self.headers)
-
-        if not resp or resp.status_code != 200:
+        import requests
+        data = json.dumps(items).encode('utf-8', 'replace')
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                log.warning(f'Retrying in {delay:.1f}s; attempt {attempt} of {self.retries}')
+                time.sleep(delay)
+            try:
+                resp = self.session.post(url, data=data, headers=self.headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                log.error(f'Solr posting failed: {e}')
+                continue
+            if resp.status_code == 200:
+                return True
             log.error(f'Solr posting failed {resp.status_code}')
-            return False
-        return True
+            if resp.status_code < 500 and resp.status_code != 429:
+                break   # the request itself is bad, retrying does not help
+        return False
 
-    def post_iterator(self, iter, commit=False, soft_commit=False, buffer_size=100, progress_delay=2000):
+    def post_iterator(self, iter, commit=False, soft_commit=False, buffer_size=100, progress_delay=2000,
+                      workers=4):
         """
         Posts all the items yielded by the input iterator to Solr;
         The documents will be buffered and sent in batches
@@ -48,40 +76,55 @@ class Solr(object):
         :param soft_commit: soft commit after each call ? default is false
         :param buffer_size: number of docs to buffer and post at once
         :param progress_delay: the number of milliseconds of
-        :return: (numDocs, True) on success, (numDocs, False) on failure
+        :param workers: number of batches to post concurrently; the iterator is not advanced while these many
+         batches are in flight
+        :return: (numDocs, True) on success, (numDocs, False) if any batch failed even after the retries
         """
-        buffer = []
         count = 0
         num_docs = 0
-        tt = current_milli_time()
-        for doc in iter:
-            num_docs += 1
-            buffer.append(doc)
-
-            if len(buffer) >= buffer_size:
-                # buffer full, post them
-                count += 1
-                if self.post_items(buffer, commit=commit, soft_commit=soft_commit):
-                    # going good, clear them all
-                    del buffer[:]
-                else:
-                    log.error(f'Solr posting failed. batch number={count}')
-                    return num_docs, False
-
-            if (current_milli_time() - tt) > progress_delay:
-                tt = current_milli_time()
-                log.info("%d batches, %d docs " % (count, num_docs))
-
-        res = True
-        if buffer:
-            res = self.post_items(buffer, commit=commit, soft_commit=soft_commit)
-        return num_docs, res
+        failed_batches, failed_docs = 0, 0
+        st = tt = current_milli_time()
+        in_flight = deque()
+
+        def collect(fut, batch_num, size):
+            nonlocal failed_batches, failed_docs
+            if not fut.result():
+                log.error(f'Solr posting failed. batch number={batch_num}, docs={size}')
+                failed_batches += 1
+                failed_docs += size
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            buffer = []
+            end = object()
+            for doc in itertools.chain(iter, [end]):
+                if doc is not end:
+                    num_docs += 1
+                    buffer.append(doc)
+                if buffer and (len(buffer) >= buffer_size or doc is end):
+                    count += 1
+                    while len(in_flight) >= workers:    # backpressure
+                        collect(*in_flight.popleft())
+                    fut = pool.submit(self.post_items, buffer, commit=commit, soft_commit=soft_commit)
+                    in_flight.append((fut, count, len(buffer)))
+                    buffer = []
+
+                if (current_milli_time() - tt) > progress_delay:
+                    tt = current_milli_time()
+                    rate = num_docs * 1000 / max(tt - st, 1)
+                    log.info("%d batches, %d docs, %.1f docs/sec" % (count, num_docs, rate))
+            while in_flight:
+                collect(*in_flight.popleft())
+
+        rate = num_docs * 1000 / max(current_milli_time() - st, 1)
+        log.info("Posted %d docs in %d batches, %.1f docs/sec; failed: %d batches, %d docs"
+                 % (num_docs - failed_docs, count, rate, failed_batches, failed_docs))
+        return num_docs, failed_batches == 0
 
     def commit(self):
         """
         Commit index
         """
-        resp = requests.post(self.update_url + '?commit=true')
+        resp = self.session.post(self.update_url + '?commit=true', timeout=self.timeout)
         if resp.status_code == 200:
             self.posted_items = 0
         return resp
@@ -91,20 +134,9 @@ class Solr(object):
         Queries solr and returns results as a dictionary
         returns None on failure, items on success
         """
-        payload = {
-            'q': query,
-            'wt': 'python',
-            'start': start,
-            'rows': rows
-        }
-
-        if kwargs:
-            for key in kwargs:
-                payload[key] = kwargs.get(key)
-
-        resp = requests.get(self.query_url, params=payload)
+        resp = self.query_raw(query, start, rows, **kwargs)
         if resp.status_code == 200:
-            return eval(resp.text)
+            return json.loads(resp.content)
         else:
             log.error(f'Status: {resp.status_code}')
             return None
@@ -115,7 +147,7 @@ class Solr(object):
         """
         payload = {
             'q': query,
-            'wt': 'python',
+            'wt': 'json',
             'start': start,
             'rows': rows
         }
@@ -124,39 +156,54 @@ class Solr(object):
             for key in kwargs:
                 payload[key] = kwargs.get(key)
 
-        return requests.get(self.query_url, params=payload)
+        return self.session.get(self.query_url, params=payload, timeout=self.timeout)
 
-    def query_iterator(self, query='*:*', start=0, rows=20, **kwargs):
+    def query_iterator(self, query='*:*', start=0, rows=20, unique_key='id', prefetch=True, **kwargs):
         """
-        Queries solr server and returns Solr response  as dictionary
+        Queries solr server and iterates over all the results, page by page with a cursorMark.
+        Unlike start offsets, a cursor costs the same for the last page as for the first.
+        :param start: number of results to skip (cursors can not start at an offset, so they are skipped here)
+        :param unique_key: unique key field of the schema; the sort order is made total with it
+        :param prefetch: fetch the next page on a background thread while the current one is consumed
         returns None on failure, iterator of results on success
         """
-        payload = {'q': query, 'wt': 'python', 'rows': rows}
+        payload = {'q': query, 'wt': 'json', 'rows': rows}
 
         if kwargs:
             for key in kwargs:
                 payload[key] = kwargs.get(key)
-
-        total = start + 1
-        while start < total:
-            payload['start'] = start
-            log.debug('start = %s, total= %s' % (start, total))
-            resp = requests.get(self.query_url, params=payload)
-            if not resp:
-                log.warning('no response from solr server!')
-                break
-
-            if resp.status_code == 200:
-                resp = eval(resp.text)
-                total = resp['response']['numFound']
-                for doc in resp['response']['docs']:
-                    start += 1
-                    yield doc
-            else:
+        payload.pop('start', None)
+        sort = payload.get('sort')
+        sort_fields = [clause.split()[0] for clause in sort.split(',') if clause.strip()] if sort else []
+        if unique_key not in sort_fields:
+            payload['sort'] = f'{sort}, {unique_key} asc' if sort else f'{unique_key} asc'
+
+        def fetch(cursor):
+            params = dict(payload, cursorMark=cursor)
+            resp = self.session.get(self.query_url, params=params, timeout=self.timeout)
+            if resp.status_code != 200:
                 log.error(resp)
                 log.error('Oops! Some thing went wrong while querying solr')
-                log.error('Solr query params = %s', payload)
-                break
+                log.error('Solr query params = %s', params)
+                return None
+            return json.loads(resp.content)
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            cursor, skip = '*', start
+            page = fetch(cursor)
+            while page:
+                next_cursor = page['nextCursorMark']
+                log.debug('cursor = %s, total= %s' % (cursor, page['response']['numFound']))
+                done = next_cursor == cursor
+                next_page = pool.submit(fetch, next_cursor) if prefetch and not done else None
+                docs = page['response']['docs']
+                if skip:
+                    docs, skip = docs[skip:], max(0, skip - len(docs))
+                yield from docs
+                if done:
+                    break
+                cursor = next_cursor
+                page = next_page.result() if next_page else fetch(cursor)
 
     def __del__(self):
         """ commit pending docs before close """
@@ -164,8 +211,19 @@ class Solr(object):
         log.info('Solr: status = %s' % self.commit())
 
 
-def main(url, queries, start, rows, out, fl=None, tsv=False, limit=None, sort=None):
-    solr = Solr(url)
+def connect(url, **kwargs):
+    """
+    Client for a search index: solr.Solr for http(s) URLs, localindex.LocalIndex for anything else (a file path)
+    :param kwargs: options of Solr(); they are of no use for a local index
+    """
+    if url.startswith(('http://', 'https://')):
+        return Solr(url, **kwargs)
+    from localindex import LocalIndex
+    return LocalIndex(url)
+
+
+def main(url, queries, start, rows, out, fl=None, tsv=False, limit=None, sort=None, prefetch=True):
+    solr = connect(url)
     extra = {}
     if fl:
         extra['fl'] = fl
@@ -185,7 +243,7 @@ def main(url, queries, start, rows, out, fl=None, tsv=False, limit=None, sort=No
         return json.dumps(doc, ensure_ascii=False)
 
     count = 0
-    for doc in solr.query_iterator(queries[0], start, rows, **extra):
+    for doc in solr.query_iterator(queries[0], start, rows, prefetch=prefetch, **extra):
         line = out_fmt(doc)
         out.write(line)
         out.write('\n')
@@ -198,7 +256,7 @@ def main(url, queries, start, rows, out, fl=None, tsv=False, limit=None, sort=No
 if __name__ == '__main__':
     import argparse, sys
     p = argparse.ArgumentParser()
-    p.add_argument('url', type=str, help='Solr URL')
+    p.add_argument('url', type=str, help='Solr URL, or path to a local index (see localindex.py)')
     p.add_argument('queries', type=str, nargs='+', help='Filter Queries')
     p.add_argument('-s', '--start', type=int, default=0, help='start from result index')
     p.add_argument('-r', '--rows', type=int, default=1000, help='batch size')
@@ -207,5 +265,7 @@ if __name__ == '__main__':
     p.add_argument('--sort', type=str, help='sort by')
     p.add_argument('-o', '--out', type=argparse.FileType('w'), help='Output File', default=sys.stdout)
     p.add_argument('--tsv', action='store_true', help='Output TSV instead of JSON  Line')
+    p.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+                   help='Do not fetch the next page while writing the current one')
     args = vars(p.parse_args())
     main(**args)
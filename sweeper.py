@@ -0,0 +1,304 @@
+"""
+Threshold sweep: scores the document pairs once, and reports the alignments for many thresholds.
+
+The segment pair scores of each document pair are computed as realigner does, and saved to a score dir as a
+compressed float32 matrix ({src_id}.{eng_id}.npz, along with the segment ids and the scorer fingerprint), so that
+the later sweeps with other thresholds do not parse or score anything again. The fingerprint covers the flags, the
+model files and the scorer options (see scorer.get_fingerprint); the scores of another setup are computed again.
+Greedy matching takes the pairs in the descending order of scores, so the matching at any threshold is the
+prefix (scores >= threshold) of the matching at the lowest threshold; one matching per document pair gives the
+alignments of all the thresholds.
+
+For every threshold, the report has the number of aligned pairs, of documents having any alignment, the mean
+score and, given a reference alignment, the precision, recall and F1 of the aligned pairs. The histograms of the
+candidate scores and of the matched scores follow. See realigner.py for the scorer arguments.
+"""
+import argparse
+import logging as log
+import multiprocessing as mp
+import os
+import sys
+import xml.etree.ElementTree as et
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+from ltfreader import read_ltf_doc
+import vfs
+from realigner import Alignment, ReAlignTask, read_doc_alignments, score_segs
+from scorer import get_fingerprint, get_scorer
+
+log.basicConfig(level=log.INFO)
+debug_mode = False
+
+Match = Tuple[str, str, float]    # (src_sid, tgt_sid, score)
+hist_range = (-1.0, 1.0)
+
+
+def save_scores(path: str, src_sids: List[str], tgt_sids: List[str], scores: np.ndarray, flags: str,
+                fingerprint: int):
+    tmp_path = f'{path}.tmp{os.getpid()}.npz'
+    np.savez_compressed(tmp_path, src=np.array(src_sids), tgt=np.array(tgt_sids), scores=scores.astype(np.float32),
+                        flags=np.array(flags), fingerprint=np.array(fingerprint, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def load_scores(path: str, fingerprint: int) -> Optional[Tuple[List[str], List[str], np.ndarray]]:
+    """:return: (src_sids, tgt_sids, score matrix); None if missing or scored with another scorer setup"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if 'fingerprint' not in data or int(data['fingerprint']) != fingerprint:
+            log.warning(f"{path} was scored with another setup (flags={data['flags']}); scoring again")
+            return None
+        return data['src'].tolist(), data['tgt'].tolist(), data['scores']
+
+
+def greedy_matches(src_sids: List[str], tgt_sids: List[str], scores: np.ndarray, threshold=0.0) -> List[Match]:
+    """
+    Same matching as realigner.greedy_match, on a score matrix
+    :return: matches in the descending order of scores
+    """
+    flat = scores.ravel()
+    cands = np.flatnonzero(flat >= threshold)
+    # stable, so that ties are broken in the row major order, as sorted() does on the scores dict
+    cands = cands[np.argsort(-flat[cands], kind='stable')]
+    n_tgt, limit = len(tgt_sids), min(len(src_sids), len(tgt_sids))
+    src_done, tgt_done, res = set(), set(), []
+    for idx in cands.tolist():
+        i, j = divmod(idx, n_tgt)
+        if i not in src_done and j not in tgt_done:
+            src_done.add(i)
+            tgt_done.add(j)
+            res.append((src_sids[i], tgt_sids[j], float(flat[idx])))
+            if len(res) == limit:
+                break
+    return res
+
+
+class SweepTask(ReAlignTask):
+    """Scores a document pair, or loads its scores from the score dir, and matches at the lowest threshold"""
+
+    def __init__(self, found_dir, score_dir, scorer, flags, fingerprint, threshold, bins):
+        super().__init__(found_dir, out_dir=None, scorer=scorer, threshold=threshold)
+        self.score_dir = score_dir
+        self.flags = flags
+        self.fingerprint = fingerprint
+        self.bins = bins
+
+    def score_path(self, src_id, eng_id):
+        return f'{self.score_dir}/{src_id}.{eng_id}.npz'
+
+    def scores(self, src_id, eng_id):
+        path = self.score_path(src_id, eng_id)
+        res = load_scores(path, self.fingerprint)
+        if res is None:
+            log.info(f"Going to score {src_id} x {eng_id}")
+            src_doc = read_ltf_doc(self.ltf_path(src_id))
+            eng_doc = read_ltf_doc(self.ltf_path(eng_id))
+            src_sids = [sid for sid, _ in src_doc.get_segs()]
+            tgt_sids = [sid for sid, _ in eng_doc.get_segs()]
+            scores = score_segs(src_doc, eng_doc, self.scorer)
+            matrix = np.array([scores[(s, t)] for s in src_sids for t in tgt_sids], dtype=np.float32)
+            matrix = matrix.reshape(len(src_sids), len(tgt_sids))
+            save_scores(path, src_sids, tgt_sids, matrix, self.flags, self.fingerprint)
+            res = src_sids, tgt_sids, matrix
+        return res
+
+    def run(self, ids):
+        """:return: (src_id, eng_id, matches, histogram of the candidate scores)"""
+        src_id, eng_id = self.order_ids(ids)
+        src_sids, tgt_sids, scores = self.scores(src_id, eng_id)
+        hist = score_histogram(scores, self.bins)
+        return src_id, eng_id, greedy_matches(src_sids, tgt_sids, scores, self.threshold), hist
+
+
+def score_histogram(scores: np.ndarray, bins: int) -> np.ndarray:
+    """
+    Counts of scores in equal bins of [-1, 1], the range of the scorers; the pairs rejected by the heuristics (-1)
+    are in the first bin, apart from the pairs which scored about 0
+    """
+    return np.histogram(np.clip(scores, *hist_range), bins=bins, range=hist_range)[0]
+
+
+def _src_first(aln: Alignment) -> Alignment:
+    """Makes the non-english document the source side"""
+    src_id, _ = ReAlignTask.order_ids((aln.src_id, aln.tgt_id))
+    if src_id == aln.src_id:
+        return aln
+    return Alignment(aln.tgt_id, aln.src_id, [(tgts, srcs, score) for srcs, tgts, score in aln.alignments])
+
+
+def read_aln_xml(path) -> Alignment:
+    with vfs.open_file(path) as f:
+        root = et.parse(f).getroot()
+    aligns = [(el.find('source').attrib['segments'].split(), el.find('translation').attrib['segments'].split(),
+               float(el.attrib.get('score', 'nan'))) for el in root.iter('alignment')]
+    return Alignment(root.attrib['source_id'], root.attrib['translation_id'], aligns)
+
+
+def read_reference(path) -> Set[Tuple[str, str]]:
+    """
+    Reads the aligned segment pairs of a reference: a directory of *.aln.xml files, or an alignment store
+    :return: {(src_doc_id.seg_id, eng_doc_id.seg_id)}; many to many alignments count as all their segment pairs
+    """
+    if os.path.isdir(path) or vfs.in_archive(path):
+        alns = map(read_aln_xml, vfs.glob_files(f'{path}/*.aln.xml'))
+    else:
+        from alnstore import read_alignments
+        alns = read_alignments(path)
+    return {(f'{aln.src_id}.{s}', f'{aln.tgt_id}.{t}')
+            for aln in map(_src_first, alns) for srcs, tgts, _ in aln.alignments for s in srcs for t in tgts}
+
+
+def sweep(doc_mapping: List[Tuple[str, str]], task: SweepTask, thresholds: List[float], threads=2,
+          reference: Optional[Set[Tuple[str, str]]] = None, out_alns=None) -> Dict:
+    """
+    Matches all the document pairs once, and summarizes the alignments at each threshold
+    :param out_alns: if given, the alignments of each threshold are written to an alignment store
+      {out_alns}/threshold-{t}.jsonl.gz (see alnstore.py)
+    :return: dict of the per threshold stats and the histograms
+    """
+    thresholds = sorted(thresholds)
+    assert task.threshold <= thresholds[0]
+    writers = None
+    if out_alns:
+        from alnstore import AlignmentWriter
+        os.makedirs(out_alns, exist_ok=True)
+        paths = [f'{out_alns}/threshold-{t:g}.jsonl.gz' for t in thresholds]
+        for path in paths:
+            if os.path.exists(path):    # the stores append, but a sweep replaces its alignments
+                os.remove(path)
+        writers = [AlignmentWriter(path) for path in paths]
+    cand_hist = np.zeros(task.bins, dtype=np.int64)
+    matched, correct, doc_max = [], [], []
+    pairs = set()
+    if threads > 1:
+        pool = mp.Pool(threads)
+        results = pool.imap_unordered(task.run, doc_mapping)
+    else:
+        pool, results = None, map(task.run, doc_mapping)
+    try:
+        for src_id, eng_id, matches, hist in results:
+            pairs.add((src_id, eng_id))
+            cand_hist += hist
+            doc_max.append(matches[0][2] if matches else -np.inf)
+            for src_sid, tgt_sid, score in matches:
+                matched.append(score)
+                if reference is not None:
+                    correct.append((f'{src_id}.{src_sid}', f'{eng_id}.{tgt_sid}') in reference)
+            if writers:
+                for t, writer in zip(thresholds, writers):
+                    aligns = [([s], [g], score) for s, g, score in matches if score >= t]
+                    if aligns:
+                        writer.write(Alignment(src_id, eng_id, aligns))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        for writer in writers or []:
+            writer.close()
+
+    matched, doc_max = np.array(matched), np.array(doc_max)
+    order = np.argsort(-matched, kind='stable')
+    matched = matched[order]
+    cum_scores = np.cumsum(matched)
+    cum_correct = np.cumsum(np.array(correct, dtype=np.int64)[order]) if reference is not None else None
+    n_ref = sum(1 for src, eng in reference if (src.rsplit('.', 1)[0], eng.rsplit('.', 1)[0]) in pairs) \
+        if reference is not None else 0
+    stats = []
+    for t in thresholds:
+        n = int(np.searchsorted(-matched, -t, side='right'))    # count of matched scores >= t
+        row = {'threshold': t, 'pairs': n, 'docs': int((doc_max >= t).sum()),
+               'mean_score': float(cum_scores[n - 1] / n) if n else 0.0}
+        if reference is not None:
+            hits = int(cum_correct[n - 1]) if n else 0
+            prec, rec = hits / n if n else 0.0, hits / n_ref if n_ref else 0.0
+            row.update(precision=prec, recall=rec, f1=2 * prec * rec / (prec + rec) if hits else 0.0)
+        stats.append(row)
+    matched_hist = score_histogram(matched, task.bins)
+    return {'doc_pairs': len(pairs), 'reference_pairs': n_ref, 'stats': stats,
+            'candidate_hist': cand_hist, 'matched_hist': matched_hist}
+
+
+def write_report(res: Dict, out, bins: int):
+    out.write(f"# {res['doc_pairs']} document pairs")
+    if res['reference_pairs']:
+        out.write(f", {res['reference_pairs']} reference segment pairs")
+    out.write('\n')
+    cols = list(res['stats'][0].keys())
+    out.write('\t'.join(cols) + '\n')
+    for row in res['stats']:
+        out.write('\t'.join(f'{row[col]:.4f}' if isinstance(row[col], float) else str(row[col]) for col in cols))
+        out.write('\n')
+    out.write('\n# score histogram (bin start, candidates, matched at the lowest threshold)\n')
+    edges = np.linspace(*hist_range, bins + 1)
+    for start, n_cands, n_matched in zip(edges, res['candidate_hist'], res['matched_hist']):
+        out.write(f'{start:.3f}\t{n_cands}\t{n_matched}\n')
+
+
+def main(found_dir, src_lang, score_dir, flags, thresholds, out, old_aln_dir='sentence_alignment.old',
+         reference=None, out_alns=None, bins=20, **args):
+    subs = vfs.listdir(found_dir)
+    assert 'eng' in subs
+    assert src_lang in subs
+    if '/' not in score_dir:
+        archive, _ = vfs.split_archive(found_dir)
+        score_dir = f'{os.path.dirname(archive)}/{score_dir}' if archive else f'{found_dir}/{score_dir}'
+    log.info(f"Score dir {score_dir}")
+    os.makedirs(score_dir, exist_ok=True)
+    thresholds = sorted(float(t) for t in thresholds.split(','))
+    assert thresholds[-1] <= 1
+
+    aln_maps = read_doc_alignments(f'{found_dir}/{old_aln_dir}')
+    log.info(f"Found {len(aln_maps)} doc mappings")
+    ref = None
+    if reference:
+        ref = read_reference(reference)
+        log.info(f"Read {len(ref)} reference segment pairs from {reference}")
+    fingerprint = get_fingerprint(flags, **args)
+    scorer = get_scorer(flags, debug=debug_mode, **args)
+    task = SweepTask(found_dir, score_dir, scorer, flags=flags, fingerprint=fingerprint, threshold=thresholds[0],
+                     bins=bins)
+    res = sweep(aln_maps, task, thresholds, threads=args['threads'], reference=ref, out_alns=out_alns)
+    write_report(res, out, bins)
+
+
+if __name__ == '__main__':
+    from ttab import TTable, Preprocessor  # the pickler complains about not having this
+    p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-fd', '--found-dir', type=str, required=True,
+                   help='Path to "found" dir that has eng and xyz lan')
+    p.add_argument('-l', '--lang', dest='src_lang', type=str, required=True, help='source language code')
+    p.add_argument('-sd', '--score-dir', type=str, default='sweep-scores',
+                   help='Directory to keep the scores of the document pairs; the scores found in it are reused')
+    p.add_argument('-ths', '--thresholds', type=str, default='0,0.1,0.2,0.3,0.4,0.5,0.6,0.7,0.8,0.9',
+                   help='comma separated list of thresholds')
+    p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout, help='Report output')
+    p.add_argument('-r', '--reference', type=str,
+                   help='Reference alignments to compare with: directory of *.aln.xml files or an alignment store')
+    p.add_argument('-oa', '--out-alns', type=str,
+                   help='Write the alignments of each threshold to an alignment store in this directory')
+    p.add_argument('-b', '--bins', type=int, default=20, help='Number of bins of the score histograms')
+    p.add_argument('-f', '--flags', type=str, default='charlen,toklen,copypatn,ascii,ttab',
+                   help='comma separated list of scorers to use. See realigner.py')
+    p.add_argument('-d', '--debug', action='store_true', help="Turn on the debug mode")
+    p.add_argument('-nt', '--threads', type=int, default=2, help='Number of threads to use')
+
+    p.add_argument('-se', '--src-emb', type=str, help='path to source language embedding (flag=mcss)')
+    p.add_argument('-ee', '--eng-emb', type=str, help='path to english language embedding (flag=mcss)')
+    p.add_argument('-mv', '--max-vocab', type=int, default=int(1e6), help='Maximum Vocabulary size (flag=mcss)')
+    p.add_argument('-tf', '--ttab-file', type=str, help='Path to ttab file (flag=ttab)')
+    p.add_argument('-sw', '--scorer-weights', type=str,
+                   help='Weights of the scorers to combine, e.g. "mcss:2,ttab:1" (flags=mcss,ttab). Default: equal')
+    p.add_argument('-co', '--cascade-order', type=str,
+                   help='Order of the heuristics: comma separated flags, or a file saved by scorer.py --export-cascade')
+
+    args = vars(p.parse_args())
+    if args.pop('debug'):
+        log.getLogger().setLevel(level=log.DEBUG)
+        debug_mode = True
+        log.debug("Debug Mode ON")
+    main(**args)
+    log.info("Done.")
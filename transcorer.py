@@ -13,6 +13,8 @@ debug_mode = False
 class TranScorer:
     """Translation scorer"""
 
+    score_range = (0.0, 1.0)
+
     def __init__(self, ttab: TTable, combine='sum'):
         """
 
@@ -94,8 +96,11 @@ if __name__ == '__main__':
                    help='Input file path. Format: Source<tab>Target sentence per line')
     p.add_argument('-o', '--out', type=argparse.FileType('w'), default=sys.stdout,
                    help='Output file path')
-    p.add_argument('-t', '--ttab', dest='ttab_path', type=str, required=True,
+    p.add_argument('-t', '--ttab', dest='ttab_path', type=str,
                    help='Translation Table file (pickle dumb of ttab.TTable object, see ttab.py to get one)')
+    p.add_argument('-srv', '--server', type=str,
+                   help='Score with a running scoreserver.py (-f ttab) at this Unix socket path or host:port,'
+                        ' instead of loading the --ttab here')
 
     p.add_argument('--test', action='store_true',
                    help="Turn on the test mode. In test mode, assume the input is parallel text "
@@ -104,8 +109,17 @@ if __name__ == '__main__':
                    help='Number of random negative samples to test against (in --test mode)')
     p.add_argument('-s', '--seed', type=int, default=None,
                    help='seed for reproducing random shuffle for negatives (in --test mode)')
+    p.add_argument('-nt', '--threads', type=int, default=1, help='Number of processes for scoring (in --test mode)')
+    p.add_argument('-r', '--retrieval', action='store_true',
+                   help='Also report P@1 and MRR of the positives (in --test mode)')
     args = vars(p.parse_args())
-    scorer = TranScorer.new(args.pop('ttab_path'))
+    ttab_path, server = args.pop('ttab_path'), args.pop('server')
+    assert ttab_path or server, '--ttab or --server is needed'
+    if server:
+        from scoreserver import ScoreClient
+        scorer = ScoreClient(server, flags='ttab')
+    else:
+        scorer = TranScorer.new(ttab_path)
     if args.pop('test'):
         from utils import scorer_eval
         scorer_eval(scorer, **args)
@@ -1,8 +1,98 @@
 from collections import defaultdict
+from itertools import islice
+import multiprocessing as mp
 import random
 
+_scorer = None   # per worker process scorer, see init_scorer
 
-def scorer_eval(scorer, inp, out, neg_sample_count=20, verbose=True, parse=True, seed=None, **args):
+
+def init_scorer(scorer):
+    """Sets the scorer of this process; the initializer of the pools running score_chunk or score_cands"""
+    global _scorer
+    _scorer = scorer
+
+
+def score_chunk(pairs):
+    return [_scorer.score(src, tgt) for src, tgt in pairs]
+
+
+def score_cands(cands):
+    """Scores a chunk of [(src_id, eng_id, src_text, eng_text)] with the scorer of this process"""
+    return [(src_id, eng_id, _scorer.score(src_txt, eng_txt)) for src_id, eng_id, src_txt, eng_txt in cands]
+
+
+def score_pairs(scorer, pairs, threads=1, chunk_size=1000):
+    """
+    Scores a list of (src, tgt) pairs.
+    Scorers having a `score_pairs(srcs, tgts)` method (such as MCSS) score all of them at once, as matrices;
+    the others are called pair by pair, in a pool of processes when threads > 1
+    :return: list of scores, in the order of pairs
+    """
+    if not pairs:
+        return []
+    if hasattr(scorer, 'score_pairs'):
+        srcs, tgts = zip(*pairs)
+        return [float(s) for s in scorer.score_pairs(srcs, tgts)]
+    if threads <= 1:
+        return [scorer.score(src, tgt) for src, tgt in pairs]
+    pairs = iter(pairs)
+    chunks = iter(lambda: list(islice(pairs, chunk_size)), [])
+    with mp.Pool(threads, initializer=init_scorer, initargs=(scorer,)) as pool:
+        return [score for res in pool.imap(score_chunk, chunks) for score in res]
+
+
+def sample_negatives(tgt_seqs, neg_sample_count):
+    """
+    Draws the indices of negative targets for each positive, without building the list of all the other targets
+    :return: list of lists of indices; a target identical to the positive target is never drawn, and the draws
+      which hit one are made again from the rest, so a positive has fewer negatives only if there are not enough
+      distinct targets
+    """
+    n = len(tgt_seqs)
+    k = min(neg_sample_count, n - 1)
+    res = []
+    for i, pos_tgt in enumerate(tgt_seqs):
+        idxs = [j + (j >= i) for j in random.sample(range(n - 1), k)]     # skip over i itself
+        negs = [j for j in idxs if tgt_seqs[j] != pos_tgt]
+        if len(negs) < k:   # rare; only the positives having duplicate targets pay for the full list
+            tried = set(idxs)
+            rest = [j for j in range(n) if j != i and j not in tried and tgt_seqs[j] != pos_tgt]
+            negs.extend(random.sample(rest, min(k - len(negs), len(rest))))
+        res.append(negs)
+    return res
+
+
+def retrieval_metrics(scorer, src_seqs, tgt_seqs, block_size=1000):
+    """
+    Ranks all the targets for every source with the full score matrix.
+    Needs a scorer having `embed(sents, side)` which returns unit vectors (such as MCSS)
+    :return: (P@1, MRR)
+    """
+    import numpy as np
+    tgt_vecs = scorer.embed(list(tgt_seqs), side='tgt')
+    p1, rr = 0, 0.0
+    for start in range(0, len(src_seqs), block_size):
+        src_vecs = scorer.embed(list(src_seqs[start: start + block_size]), side='src')
+        sims = src_vecs @ tgt_vecs.T
+        pos = sims[np.arange(len(src_vecs)), np.arange(start, start + len(src_vecs))]
+        ranks = 1 + (sims > pos[:, None]).sum(axis=1)
+        p1 += int((ranks == 1).sum())
+        rr += float((1.0 / ranks).sum())
+    return p1 / len(src_seqs), rr / len(src_seqs)
+
+
+def sampled_retrieval_metrics(pos_scores, neg_scores):
+    """P@1 and MRR of each positive among its own sampled negatives"""
+    p1, rr = 0, 0.0
+    for pos_score, scores in zip(pos_scores, neg_scores):
+        rank = 1 + sum(score > pos_score for score in scores)
+        p1 += rank == 1
+        rr += 1.0 / rank
+    return p1 / len(pos_scores), rr / len(pos_scores)
+
+
+def scorer_eval(scorer, inp, out, neg_sample_count=20, verbose=True, parse=True, seed=None, threads=1,
+                retrieval=False, **args):
     """
     :param scorer: scorer to evaluate on
     :param inp: input having parallel data (positive examples)
@@ -10,6 +100,9 @@ def scorer_eval(scorer, inp, out, neg_sample_count=20, verbose=True, parse=True,
     :param neg_sample_count: number of negative samples to make
     :param verbose: print out negative
     :param parse: parse the input by splitting it into source and target sentences
+    :param threads: number of processes for scoring
+    :param retrieval: also report P@1 and MRR; over all the targets if the scorer can embed sentences,
+      otherwise over the sampled negatives
     :return: error percentage
     """
     if seed is not None:
@@ -18,33 +111,38 @@ def scorer_eval(scorer, inp, out, neg_sample_count=20, verbose=True, parse=True,
     pos_exs = list(pos_exs)
     pos_count = len(pos_exs)
     assert pos_count > neg_sample_count
-    src_sqs, tgt_seqs = zip(*pos_exs)
-    pos_scores = {src: scorer.score(src, tgt) for src, tgt in pos_exs}
+    src_seqs, tgt_seqs = zip(*pos_exs)
+    pos_scores = score_pairs(scorer, pos_exs, threads=threads)
     # assert len(pos_scores) == pos_count , 'Unique sentences'
+    neg_idxs = sample_negatives(tgt_seqs, neg_sample_count)
+    flat_scores = score_pairs(scorer, [(src, tgt_seqs[j]) for src, idxs in zip(src_seqs, neg_idxs) for j in idxs],
+                              threads=threads)
+    neg_scores, pos = [], 0
+    for idxs in neg_idxs:
+        neg_scores.append(flat_scores[pos: pos + len(idxs)])
+        pos += len(idxs)
+
     error_tgts = defaultdict(set)
     neg_error = 0.0
     neg_count = 0
-    for src, pos_tgt in pos_exs:
-        neg_tgts = [t for t in tgt_seqs if t != pos_tgt]
-        random.shuffle(neg_tgts)
-        for neg_tgt in neg_tgts[:neg_sample_count]:
-            pred_score = scorer.score(src, neg_tgt)
-            if pred_score > pos_scores[src]:
-                error_tgts[src].add((pred_score, neg_tgt))
+    for i, (idxs, scores) in enumerate(zip(neg_idxs, neg_scores)):
+        for j, pred_score in zip(idxs, scores):
+            if pred_score > pos_scores[i]:
+                error_tgts[i].add((pred_score, tgt_seqs[j]))
             # assumption: negative score is definitely zero/neg class
             neg_error += max(0, pred_score) ** 2
             neg_count += 1
-    neg_mse = (neg_error / neg_count) ** 0.5
+    neg_mse = (neg_error / neg_count) ** 0.5 if neg_count else 0.0
     # assumption: anything above 1 is definitely one/pos class
-    pos_errors = [(1.0 - min(1.0, v)) ** 2 for v in pos_scores.values()]
+    pos_errors = [(1.0 - min(1.0, v)) ** 2 for v in pos_scores]
     pos_mse = (sum(pos_errors) / len(pos_errors)) ** 0.5
     err_count = 0
     for i, (src, pos_tgt) in enumerate(pos_exs):
-        pos_tgt_score = pos_scores[src]
-        if error_tgts[src]:
+        pos_tgt_score = pos_scores[i]
+        if error_tgts[i]:
             err_count += 1
             out.write(f'{i+1:5}\t[FALSE NEG]\t{pos_tgt_score:.4f}\t{src}\t{pos_tgt}\n')
-            errs_sorted = sorted(error_tgts[src], key=lambda x: x[0], reverse=True)
+            errs_sorted = sorted(error_tgts[i], key=lambda x: x[0], reverse=True)
             errs_sorted = errs_sorted if verbose else errs_sorted[:1]
             for err_tgt_score, err_tgt in errs_sorted:
                 out.write(f'\t[FALSE POS]\t{err_tgt_score:.4f}\t{err_tgt}\n')
@@ -55,9 +153,22 @@ def scorer_eval(scorer, inp, out, neg_sample_count=20, verbose=True, parse=True,
     error_percent = 100.0 * err_count / len(pos_exs)
     out.write(f'Errors: {error_percent:.2f}% \n'
               f'Stats : {err_count} out of {len(pos_exs)} source sentences were scored higher with wrong targets\n')
-    out.write(f"Positives: {len(pos_exs)}  Negatives: {len(pos_exs)} x {neg_sample_count} = {neg_count}\n")
+    if neg_count == len(pos_exs) * neg_sample_count:
+        out.write(f"Positives: {len(pos_exs)}  Negatives: {len(pos_exs)} x {neg_sample_count} = {neg_count}\n")
+    else:   # not enough distinct targets for some positives
+        short = sum(1 for idxs in neg_idxs if len(idxs) < neg_sample_count)
+        out.write(f"Positives: {len(pos_exs)}  Negatives: {neg_count}; {short} positives have fewer than"
+                  f" {neg_sample_count} distinct negative targets\n")
     out.write(f"Mean-squared diff of positives from 1.0: {pos_mse:.4f}\n")
     out.write(f"Mean-squared diff of negatives from 0.0: {neg_mse:.4f}\n")
     error = (pos_count * pos_mse + neg_count * neg_mse) / (pos_count + neg_count)
     out.write(f"Mean-squared diff (averaged)-----------: {error:.4f}\n")
+    if retrieval:
+        if hasattr(scorer, 'embed'):
+            p1, mrr = retrieval_metrics(scorer, src_seqs, tgt_seqs)
+            scope = f'all {len(tgt_seqs)} targets'
+        else:
+            p1, mrr = sampled_retrieval_metrics(pos_scores, neg_scores)
+            scope = 'the sampled negatives'
+        out.write(f"Retrieval among {scope}: P@1: {p1:.4f}  MRR: {mrr:.4f}\n")
     return error_percent
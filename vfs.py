@@ -0,0 +1,283 @@
+"""
+Virtual file system for reading LDC packages without extracting them.
+
+An archive (.tar, .tar.gz, .tgz, .zip) is treated like a directory in the path, for example
+    /data/il9.tgz/set0/data/translation/found/eng/ltf/ENG_DF_001.ltf.xml
+The member index (name -> offset) is built once per archive per process. Members of a compressed
+tarball are reached through `SeekableGzip`, which keeps decompressor checkpoints so that a seek does not
+decompress the archive from the start.
+Plain paths go straight to the local file system.
+"""
+import builtins
+import fnmatch
+import glob
+import io
+import logging as log
+import os
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+ARCHIVE_EXTS = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+
+class SeekableGzip(io.RawIOBase):
+    """
+    Read only, seekable view of a gzip file.
+    While reading forward, a checkpoint (uncompressed offset, compressed offset, copy of the decompressor)
+    is kept every `spacing` bytes of output; a seek resumes from the nearest checkpoint before the target.
+    """
+
+    def __init__(self, path, spacing=4 * 1024 * 1024, chunk_size=64 * 1024, points=None):
+        """
+        :param path: path to the gzip file
+        :param spacing: number of uncompressed bytes between the checkpoints
+        :param chunk_size: number of compressed bytes to decompress at once
+        :param points: checkpoints of another reader of the same file, to share them
+        """
+        super().__init__()
+        self.path = path
+        self.spacing = spacing
+        self.chunk_size = chunk_size
+        self._file = builtins.open(path, 'rb')
+        self.points: List[Tuple[int, int, Optional[object]]] = points if points else [(0, 0, None)]
+        self._restore(self.points[0])
+
+    def _restore(self, point):
+        uncomp_pos, comp_pos, dec = point
+        self._file.seek(comp_pos)
+        self._dec = dec.copy() if dec else zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self._buf = bytearray()
+        self._buf_start = self._pos = uncomp_pos
+        self._eof = False
+
+    def _fill(self):
+        """Decompresses the next chunk into the buffer; returns False at the end of file"""
+        chunk = self._file.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        data = self._dec.decompress(chunk)
+        while self._dec.eof and self._dec.unused_data:    # concatenated gzip members
+            rest = self._dec.unused_data
+            self._dec = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            data += self._dec.decompress(rest)
+        self._buf += data
+        out_end = self._buf_start + len(self._buf)
+        if out_end >= self.points[-1][0] + self.spacing:
+            self.points.append((out_end, self._file.tell(), self._dec.copy()))
+        return True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            while self._fill():
+                self._trim()
+            offset += self._buf_start + len(self._buf)
+        buf_end = self._buf_start + len(self._buf)
+        if not (self._buf_start <= offset <= buf_end + self.spacing):
+            point = self.points[bisect_right([p[0] for p in self.points], offset) - 1]
+            if offset < self._buf_start or point[0] > buf_end:
+                self._restore(point)
+        self._pos = offset
+        return offset
+
+    def _trim(self):
+        """Drops the buffered bytes before the current position"""
+        drop = min(self._pos - self._buf_start, len(self._buf))
+        if drop > 0:
+            del self._buf[:drop]
+            self._buf_start += drop
+
+    def read(self, size=-1):
+        self._trim()
+        if size is None or size < 0:
+            while self._fill():
+                pass
+        else:
+            while self._buf_start + len(self._buf) < self._pos + size and self._fill():
+                self._trim()
+        start = self._pos - self._buf_start
+        if start < 0 or start >= len(self._buf):
+            return b''
+        end = len(self._buf) if size is None or size < 0 else start + size
+        data = bytes(self._buf[start:end])
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class Archive(ABC):
+    """Member index of an archive; members are read fully into memory, they are small XML files"""
+
+    def __init__(self, path):
+        self.path = path
+        self.members: Dict[str, Tuple[int, int]] = {}    # name -> (offset, size)
+        self.dirs = set()
+        self._pid = None
+        self._handle = None
+
+    def _add(self, name, offset, size):
+        if name.startswith('./'):
+            name = name[2:]
+        self.members[name] = (offset, size)
+        parts = name.split('/')
+        for i in range(1, len(parts)):
+            self.dirs.add('/'.join(parts[:i]))
+
+    def handle(self):
+        """File handle of this process; forked workers must not share the file position of the parent"""
+        if self._pid != os.getpid():
+            self._handle = self._open()
+            self._pid = os.getpid()
+        return self._handle
+
+    @abstractmethod
+    def _open(self):
+        """:return: a new file handle of the archive"""
+
+    @abstractmethod
+    def read(self, name) -> bytes:
+        """:return: content of a member"""
+
+
+class TarArchive(Archive):
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.compressed = path.endswith(('.gz', '.tgz'))
+        with tarfile.open(fileobj=self.handle(), mode='r:') as tar:
+            for info in tar:
+                if info.isfile():
+                    self._add(info.name, info.offset_data, info.size)
+
+    def _open(self):
+        if self.compressed:   # checkpoints of the parent process are valid in the forked workers too
+            return SeekableGzip(self.path, points=self._handle.points if self._handle else None)
+        return builtins.open(self.path, 'rb')
+
+    def read(self, name) -> bytes:
+        offset, size = self.members[name]
+        handle = self.handle()
+        handle.seek(offset)
+        return handle.read(size)
+
+
+class ZipArchive(Archive):
+
+    def __init__(self, path):
+        super().__init__(path)
+        for info in self.handle().infolist():
+            if not info.is_dir():
+                self._add(info.filename, info.header_offset, info.file_size)
+
+    def _open(self):
+        return zipfile.ZipFile(self.path)
+
+    def read(self, name) -> bytes:
+        return self.handle().read(name)
+
+
+_archives: Dict[str, Archive] = {}
+
+
+def get_archive(path) -> Archive:
+    if path not in _archives:
+        log.info(f"Indexing archive {path}")
+        _archives[path] = ZipArchive(path) if path.endswith('.zip') else TarArchive(path)
+        log.info(f"Found {len(_archives[path].members)} members in {path}")
+    return _archives[path]
+
+
+def split_archive(path) -> Tuple[Optional[str], str]:
+    """
+    Splits a path into the archive and the path inside it
+    :return: (archive_path, inner_path) ; archive_path is None when the path is not inside an archive
+    """
+    path = os.path.normpath(path)
+    parts = path.split(os.sep)
+    for i in range(1, len(parts) + 1):
+        prefix = os.sep.join(parts[:i])
+        if prefix.endswith(ARCHIVE_EXTS) and os.path.isfile(prefix):
+            return prefix, '/'.join(parts[i:])
+    return None, path
+
+
+def in_archive(path) -> bool:
+    return split_archive(path)[0] is not None
+
+
+def open_file(path):
+    """Opens a file for reading in binary mode"""
+    archive, inner = split_archive(path)
+    if archive is None:
+        return builtins.open(path, 'rb')
+    return io.BytesIO(get_archive(archive).read(inner))
+
+
+def glob_files(pattern) -> List[str]:
+    """glob.glob, which also matches inside archives"""
+    archive, inner = split_archive(os.path.dirname(pattern))
+    if archive is None:
+        return glob.glob(pattern)
+    return [os.path.join(archive, name) for name in get_archive(archive).members
+            if posixpath.dirname(name) == inner and fnmatch.fnmatchcase(name, f'{inner}/{os.path.basename(pattern)}'
+                                                                       if inner else os.path.basename(pattern))]
+
+
+def scan(dir_path, pattern='*') -> List[Tuple[str, int, int]]:
+    """
+    Lists the files matching a pattern in a directory, along with their mtime and size.
+    Members of an archive get the mtime of the archive
+    :return: [(path, mtime_ns, size)]
+    """
+    archive, inner = split_archive(dir_path)
+    if archive is None:
+        with os.scandir(dir_path) as entries:
+            return [(entry.path, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries
+                    if entry.is_file() and fnmatch.fnmatch(entry.name, pattern)]
+    mtime = os.stat(archive).st_mtime_ns
+    arch = get_archive(archive)
+    return [(path, mtime, arch.members[split_archive(path)[1]][1])
+            for path in glob_files(os.path.join(dir_path, pattern))]
+
+
+def listdir(path) -> List[str]:
+    """os.listdir, which also lists directories inside archives"""
+    archive, inner = split_archive(path)
+    if archive is None:
+        return os.listdir(path)
+    arch = get_archive(archive)
+    prefix = f'{inner}/' if inner else ''
+    names = {name[len(prefix):].split('/')[0] for name in (*arch.members, *arch.dirs) if name.startswith(prefix)}
+    return sorted(name for name in names if name)
+
+
+def exists(path) -> bool:
+    archive, inner = split_archive(path)
+    if archive is None:
+        return os.path.exists(path)
+    arch = get_archive(archive)
+    return not inner or inner in arch.members or inner in arch.dirs